@@ -0,0 +1,86 @@
+"""This is the asynchronous (ASGI) Plateypus backend.
+
+It serves the search endpoints of the backend without blocking a worker while
+Elasticsearch is queried, so a single process can serve many concurrent
+clients. Run it with an ASGI server, e.g. ``hypercorn plateypus.asgi:PLATEYPUS''.
+Responses are not cached."""
+
+from json import dumps
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import NotFoundError
+from quart import Quart, jsonify, request
+
+try:  # pragma: no cover
+    from helpers import (
+        app_settings,
+        elastic_options,
+        init_logger,
+        normalise_fields,
+        search_page,
+        search_validator,
+    )
+    from models import INDEX_VEHICLES, vehicle_lookup, vehicle_search
+except (ImportError, ModuleNotFoundError):  # pragma: no cover
+    from plateypus.helpers import (
+        app_settings,
+        elastic_options,
+        init_logger,
+        normalise_fields,
+        search_page,
+        search_validator,
+    )
+    from plateypus.models import INDEX_VEHICLES, vehicle_lookup, vehicle_search
+
+PLATEYPUS = Quart(__name__)
+PLATEYPUS.config.from_mapping(app_settings())
+LOG = init_logger(__name__)
+
+
+@PLATEYPUS.before_serving
+async def connect():
+    """Create the Elastic client shared by all requests."""
+    url, options = elastic_options()
+    PLATEYPUS.elastic = AsyncElasticsearch(url, **options)
+
+
+@PLATEYPUS.after_serving
+async def disconnect():
+    """Close the connection pool of the Elastic client."""
+    await PLATEYPUS.elastic.close()
+
+
+@PLATEYPUS.route("/search", methods=["POST"])
+async def search():
+    """Search for the submitted license plate (fragment)."""
+    payload = await request.get_json() or {}
+    sval = search_validator()
+    if not sval.validate(payload):
+        LOG.info("invalid search request: %s", sval.errors)
+        return jsonify(sval.errors), 400
+    page = search_page(sval.document)
+    body = vehicle_search(normalise_fields(payload["fields"]), **page).to_dict()
+    resp = await PLATEYPUS.elastic.search(index=INDEX_VEHICLES, body=body)
+    hits = resp["hits"]["hits"]
+    headers = {}
+    if len(hits) == page["size"] and hits[-1].get("sort"):
+        headers["X-Search-After"] = dumps(hits[-1]["sort"])
+    return jsonify(hits), 200, headers
+
+
+@PLATEYPUS.route("/vehicle/<string:vehicle_id>")
+async def vehicle(vehicle_id):
+    """Return details for the given vehicle, as stored, like the hits of ``search''.
+
+    The raw XML of the vehicle is only included if the query parameter
+    ``raw_xml'' is ``true''."""
+    raw_xml = request.args.get("raw_xml", "False").capitalize() == "True"
+    body = vehicle_lookup(vehicle_id, raw_xml=raw_xml).to_dict()
+    try:
+        resp = await PLATEYPUS.elastic.search(index=INDEX_VEHICLES, body=body)
+    except NotFoundError:
+        resp = dict(hits=dict(hits=[]))
+    hits = resp["hits"]["hits"]
+    if hits:
+        return jsonify(hits[0]["_source"])
+    return jsonify(f"{vehicle_id} not found"), 404
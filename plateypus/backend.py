@@ -1,25 +1,131 @@
 """This is the Plateypus backend."""
 
+from collections import Counter
+from json import dumps
 from os.path import join
+from threading import Lock
 
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import NotFoundError, TransportError
+from elasticsearch_dsl import MultiSearch
 from flask import Flask, jsonify, request, send_from_directory
 from flask.logging import create_logger
+from flask_caching import Cache
 from packaging.version import Version
 
 try:  # pragma: no cover
-    from helpers import app_settings, build_query, elastic, search_validator
-    from models import Vehicle
+    from helpers import (
+        app_settings,
+        cache_key,
+        elastic,
+        facets_validator,
+        get_setting,
+        normalise_fields,
+        normalise_plate,
+        search_batch_validator,
+        search_page,
+        search_validator,
+        suggest_validator,
+    )
+    from models import (
+        FACETS,
+        Metadata,
+        Vehicle,
+        vehicle_facets,
+        vehicle_lookup,
+        vehicle_search,
+    )
 except (ImportError, ModuleNotFoundError):  # pragma: no cover
-    from plateypus.helpers import app_settings, build_query, elastic, search_validator
-    from plateypus.models import Vehicle
+    from plateypus.helpers import (
+        app_settings,
+        cache_key,
+        elastic,
+        facets_validator,
+        get_setting,
+        normalise_fields,
+        normalise_plate,
+        search_batch_validator,
+        search_page,
+        search_validator,
+        suggest_validator,
+    )
+    from plateypus.models import (
+        FACETS,
+        Metadata,
+        Vehicle,
+        vehicle_facets,
+        vehicle_lookup,
+        vehicle_search,
+    )
 
+CACHE_TYPES = dict(null="NullCache", simple="SimpleCache", redis="RedisCache")
 PLATEYPUS = Flask(__name__)
 PLATEYPUS.config.from_mapping(app_settings())
+CACHE = Cache(
+    PLATEYPUS,
+    config=dict(
+        CACHE_TYPE=CACHE_TYPES.get(
+            PLATEYPUS.config["CACHE_TYPE"], PLATEYPUS.config["CACHE_TYPE"]
+        ),
+        CACHE_NO_NULL_WARNING=True,
+        CACHE_REDIS_URL=get_setting("CACHE_REDIS_URL"),
+    ),
+)
+CACHE_STATS = Counter(hits=0, misses=0)
+CACHE_STATS_LOCK = Lock()
+CACHING = CACHE.config["CACHE_TYPE"] != "NullCache"
 LOG = create_logger(PLATEYPUS)
 VERSION = Version("0.0.1")
 
 
+def cache_get(key):
+    """Return the cached value for key, or ``None'' on a miss."""
+    value = CACHE.get(key)
+    with CACHE_STATS_LOCK:
+        CACHE_STATS["misses" if value is None else "hits"] += 1
+    return value
+
+
+def cached(key, compute):
+    """Return the cached value for key, computing and caching it on a miss."""
+    value = cache_get(key)
+    if value is None:
+        value = compute()
+        CACHE.set(key, value)
+    return value
+
+
+def generations():
+    """Return when the vehicles of each country were last updated.
+
+    Cached responses are keyed on these timestamps, so they are invalidated
+    as soon as an ETL run records a new ``last_updated'' for their country.
+    The timestamps themselves are cached for ``CACHE_METADATA_TIMEOUT''
+    seconds. With the null cache, no response is ever cached, so none are
+    looked up."""
+    if not CACHING:
+        return {}
+    gens = CACHE.get("generations")
+    if gens is None:
+        try:
+            with elastic() as client:
+                _search = Metadata.search(using=client)[:1000]
+                gens = {
+                    meta.country: meta.last_updated.isoformat()
+                    for meta in _search.execute()
+                }
+        except NotFoundError:
+            gens = {}
+        timeout = int(get_setting("CACHE_METADATA_TIMEOUT", "60"))
+        CACHE.set("generations", gens, timeout=timeout)
+    return gens
+
+
+def search_key(kind, fields, gens, *parts):
+    """Return the cache key of a search, given the generations of all countries."""
+    generation = gens.get(fields["country"]) if "country" in fields else gens
+    return cache_key(kind, fields, generation, *parts)
+
+
 @PLATEYPUS.route("/")
 def info():
     """Return application information."""
@@ -41,6 +147,13 @@ def favicon():
     )
 
 
+@PLATEYPUS.route("/cache")
+def cache_stats():
+    """Return response cache hit and miss counts for this process."""
+    with CACHE_STATS_LOCK:
+        return jsonify(CACHE_STATS)
+
+
 @PLATEYPUS.route("/echo", methods=["POST"])
 def echo():
     """Return whatever was posted."""
@@ -49,35 +162,163 @@ def echo():
     return jsonify(request.json)
 
 
+@PLATEYPUS.route("/facets")
+def facets():
+    """Return vehicle counts per maker, model, fuel type, colour and year.
+
+    Takes the query parameters ``size'', the number of values to count per
+    facet, and optionally ``country''. Counts are cached until the vehicles
+    of country are updated."""
+    sval = facets_validator()
+    if not sval.validate(request.args.to_dict()):
+        LOG.info("invalid facets request: %s", sval.errors)
+        return jsonify(sval.errors), 400
+    fields = sval.document
+
+    def execute():
+        with elastic() as client:
+            resp = vehicle_facets(using=client, **fields).execute()
+        counts = dict(total=resp.hits.total.value)
+        for facet in (*FACETS, "first_reg"):
+            counts[facet] = [
+                dict(
+                    key=getattr(bucket, "key_as_string", bucket.key),
+                    count=bucket.doc_count,
+                )
+                for bucket in resp.aggregations[facet].buckets
+            ]
+        return counts
+
+    return jsonify(cached(search_key("facets", fields, generations()), execute))
+
+
 @PLATEYPUS.route("/search", methods=["POST"])
 def search():
-    """Search for the submitted license plate (fragment)."""
+    """Search for the submitted license plate (fragment).
+
+    Returns one page of hits as a JSON array. If the page is full,
+    the ``X-Search-After'' header holds the cursor of the next page, to be
+    submitted as ``search_after''."""
     sval = search_validator()
     if not sval.validate(request.json):
         LOG.info("invalid search request: %s", sval.errors)
         return jsonify(sval.errors), 400
-    with elastic() as client:
-        _search = Vehicle.search(using=client)
-        fields = request.json["fields"]
-        if "country" in fields:
-            _search = _search.filter("term", country=fields["country"])
-        if "plate" in fields:
-            _search = _search.query(build_query("plate", fields, "2"))
-        for field in ("maker", "model", "vin"):
-            if field in fields:
-                _search = _search.query(build_query(field, fields))
-        return jsonify([hit.to_dict() for hit in _search.execute()["hits"]["hits"]])
+    fields = normalise_fields(sval.document["fields"])
+    page = search_page(sval.document)
+
+    def execute():
+        with elastic() as client:
+            _search = vehicle_search(fields, using=client, **page)
+            return [hit.to_dict() for hit in _search.execute()["hits"]["hits"]]
+
+    hits = cached(search_key("search", fields, generations(), page), execute)
+    resp = jsonify(hits)
+    if len(hits) == page["size"] and hits[-1].get("sort"):
+        resp.headers["X-Search-After"] = dumps(hits[-1]["sort"])
+    return resp
+
+
+@PLATEYPUS.route("/search/batch", methods=["POST"])
+def search_batch():
+    """Search for several license plates (fragments) in one round trip.
+
+    Results are returned in the order the fields were submitted. Each result
+    holds either the ``hits'' of its search, or an ``error'' if the fields
+    were invalid or the search failed."""
+    bval = search_batch_validator()
+    if not bval.validate(request.json):
+        LOG.info("invalid batch search request: %s", bval.errors)
+        return jsonify(bval.errors), 400
+    sval = search_validator()
+    gens = generations()
+    results = {}
+    pending = {}
+    for pos, item in enumerate(request.json["fields"]):
+        if not sval.validate(dict(fields=item)):
+            results[pos] = dict(error=sval.errors)
+            continue
+        fields = normalise_fields(item)
+        page = search_page(sval.document)
+        key = search_key("search", fields, gens, page)
+        hits = cache_get(key)
+        if hits is None:
+            pending[pos] = (key, fields, page)
+        else:
+            results[pos] = dict(hits=hits)
+
+    if pending:
+        msearch = MultiSearch()
+        for _, fields, page in pending.values():
+            msearch = msearch.add(vehicle_search(fields, **page))
+        with elastic() as client:
+            responses = client.msearch(body=msearch.to_dict())["responses"]
+        for (pos, (key, *_)), resp in zip(pending.items(), responses):
+            if "error" in resp:
+                results[pos] = dict(error=resp["error"])
+            else:
+                CACHE.set(key, resp["hits"]["hits"])
+                results[pos] = dict(hits=resp["hits"]["hits"])
+
+    return jsonify([results[pos] for pos in range(len(results))])
+
+
+@PLATEYPUS.route("/suggest")
+def suggest():
+    """Suggest license plates starting with the submitted prefix.
+
+    Takes the query parameters ``country'', ``prefix'' and, optionally,
+    ``size'', and returns up to size distinct plates of that country.
+    Requests Elasticsearch rejects are answered with its status code."""
+    sval = suggest_validator()
+    if not sval.validate(request.args.to_dict()):
+        LOG.info("invalid suggest request: %s", sval.errors)
+        return jsonify(sval.errors), 400
+    fields = dict(sval.document, prefix=normalise_plate(sval.document["prefix"]))
+
+    def execute():
+        completion = dict(
+            field="plate_suggest",
+            size=fields["size"],
+            skip_duplicates=True,
+            contexts=dict(country=[fields["country"]]),
+        )
+        with elastic() as client:
+            _search = Vehicle.search(using=client).source(False)[:0]
+            _search = _search.suggest("plates", fields["prefix"], completion=completion)
+            options = _search.execute().suggest.plates[0].options
+            return [option.text for option in options]
+
+    try:
+        return jsonify(cached(search_key("suggest", fields, generations()), execute))
+    except TransportError as error:
+        if error.status_code not in range(400, 500):
+            raise
+        LOG.info("rejected suggest request: %s", error)
+        return jsonify(error.error), error.status_code
 
 
 @PLATEYPUS.route("/vehicle/<string:vehicle_id>")
 def vehicle(vehicle_id):
-    """Return details for the given vehicle."""
-    with elastic() as client:
-        try:
-            _vehicle = Vehicle.get(vehicle_id, using=client)
-            return jsonify(_vehicle.to_dict())
-        except NotFoundError:
-            return jsonify(f"{vehicle_id} not found"), 404
+    """Return details for the given vehicle, as stored, like the hits of ``search''.
+
+    The raw XML of the vehicle is only included if the query parameter
+    ``raw_xml'' is ``true''."""
+    raw_xml = request.args.get("raw_xml", "False").capitalize() == "True"
+
+    def fetch():
+        with elastic() as client:
+            try:
+                _search = vehicle_lookup(vehicle_id, using=client, raw_xml=raw_xml)
+                hits = _search.execute()["hits"]["hits"]
+                return hits[0]["_source"].to_dict() if hits else False
+            except NotFoundError:
+                return False
+
+    key = cache_key("vehicle", vehicle_id, raw_xml, generations())
+    _vehicle = cached(key, fetch)
+    if _vehicle:
+        return jsonify(_vehicle)
+    return jsonify(f"{vehicle_id} not found"), 404
 
 
 if __name__ == "__main__":  # pragma: no cover
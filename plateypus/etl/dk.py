@@ -1,62 +1,153 @@
 """Load data from the Danish Motor Register (DMR)."""
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack
 from datetime import datetime
 from errno import ENOSPC
-from io import TextIOWrapper
+from io import BufferedReader
+from itertools import chain
 from os import strerror
 from os.path import join as path_join
-from re import search
+from re import compile as re_compile, search
 from shutil import disk_usage
 from tempfile import gettempdir
+from threading import Lock
 from zipfile import ZipFile, is_zipfile
 
 from ftputil.file_transfer import MAX_COPY_CHUNK_SIZE
 from lxml import etree  # nosec <https://github.com/PyCQA/bandit/issues/435>
 from progress.bar import Bar
-from progress.spinner import Spinner
-from pysnooper import snoop
 from pytz import utc
 from requests import get
 from requests.exceptions import ConnectionError as RequestsConnectionError
 
 try:  # pragma: no cover
     from etl_utils import (
+        FTPReader,
+        artifact_path,
+        closing_tags,
         ftp_connect,
-        get_node_text,
+        ftp_download,
+        load_vehicle_deltas,
         load_vehicles,
         ls_lt,
         newer_than_latest,
+        node_text_extractor,
+        parse_date,
+        pull_events,
+        run_ledger,
     )
 except (ImportError, ModuleNotFoundError):  # pragma: no cover
     from plateypus.etl.etl_utils import (
+        FTPReader,
+        artifact_path,
+        closing_tags,
         ftp_connect,
-        get_node_text,
+        ftp_download,
+        load_vehicle_deltas,
         load_vehicles,
         ls_lt,
         newer_than_latest,
+        node_text_extractor,
+        parse_date,
+        pull_events,
+        run_ledger,
     )
 finally:
-    from plateypus.helpers import init_logger, t_0
-    from plateypus.models import Vehicle
+    from plateypus.etl.profiling import merge, profiled_run, stage, take, timed
+    from plateypus.helpers import get_setting, init_logger, t_0
+    from plateypus.models import VehicleRecord
 
 DK = "dk"
+# The DMR dump binds its namespace to this prefix. Splitting the dump relies
+# on it to find Statistik elements in the raw bytes, without parsing them.
+DMR_PREFIX = "ns"
 LOG = init_logger(__name__)
+NODE_NAMES = (
+    "KoeretoejIdent",
+    "RegistreringNummerNummer",
+    "KoeretoejOplysningFoersteRegistreringDato",
+    "KoeretoejOplysningStelNummer",
+    "KoeretoejMaerkeTypeNavn",
+    "KoeretoejModelTypeNavn",
+    "KoeretoejVariantTypeNavn",
+    "DrivkraftTypeNavn",
+    "FarveTypeNavn",
+)
+STATISTIK_START = re_compile(rf"<{DMR_PREFIX}:Statistik[\s>]".encode())
 
 
 def extract_transform_load():
-    """Update DMR entries if newer data dump exists."""
-    dump, last_updated = Extract().download_if_newer()
-    if not dump:
-        LOG.info("No newer file found. Exiting.")
-        return False
-    entities = Transform(dump).build_from_xml()
-    if not entities:
-        LOG.info("No entities parsed from data dump. Exiting.")
-        return False
-    if not load_vehicles(DK, entities, last_updated):
-        LOG.info("No data loaded. Exiting.")
-    LOG.info("Done.")
-    return True
+    """Update DMR entries if newer data dump exists.
+
+    Only one run at a time may load the DMR; see ``run_ledger''. A full load
+    of vehicles in the order of the dump is checkpointed, and if interrupted,
+    the next run of the same dump resumes it, skipping the vehicles already
+    indexed. If ``ETL_ARTIFACT_DIR'' is set, the transformed vehicles are
+    also written to an artifact there, from which they can be reloaded with
+    ``replay''. If ``ETL_PROFILE'' is set, the time spent in each stage is
+    logged. A dump streamed from FTP is closed, with its connection, when
+    the run ends."""
+    with profiled_run(DK), run_ledger(DK) as ledger, ExitStack() as stack:
+        if ledger is None:
+            LOG.info("Another run is loading %s. Exiting.", DK)
+            return False
+        dump, last_updated = Extract().download_if_newer()
+        if not dump:
+            LOG.info("No newer file found. Exiting.")
+            return False
+        if not isinstance(dump, str):
+            stack.enter_context(dump)
+        incremental, resumable = load_mode()
+        skip = ledger.begin(last_updated.isoformat(), resumable)
+        trf = Transform(dump)
+        if int(get_setting("ETL_TRANSFORM_WORKERS", "1")) <= 1:
+            # In parallel, the offset is how far the dump has been split,
+            # which is past the vehicles checkpointed.
+            ledger.bytes_read = lambda: trf.offset
+        entities = trf.build_from_xml(skip)
+        first = next(entities, None)
+        if first is None and not skip:
+            LOG.info("No entities parsed from data dump. Exiting.")
+            ledger.update(stage="failed")
+            return False
+        vehicles = chain([first] if first else [], entities)
+        if incremental:
+            loaded = load_vehicle_deltas(
+                DK, vehicles, last_updated, artifact_path(DK, last_updated)
+            )
+        else:
+            artifact = None if skip else artifact_path(DK, last_updated)
+            checkpointed = ledger if resumable else None
+            loaded = load_vehicles(DK, vehicles, last_updated, artifact, checkpointed)
+        ledger.update(stage="done" if loaded else "failed")
+        if not loaded:
+            LOG.info("No data loaded. Exiting.")
+        LOG.info("Done.")
+        return True
+
+
+def load_mode():
+    """Return whether the load is incremental, and whether it is resumable.
+
+    Only a full load of vehicles in the order of the dump is resumable; see
+    ``ETL_LOAD_MODE'', ``ETL_TRANSFORM_WORKERS'' and ``ETL_TRANSFORM_ORDERED''."""
+    incremental = get_setting("ETL_LOAD_MODE", "full") == "incremental"
+    workers = int(get_setting("ETL_TRANSFORM_WORKERS", "1"))
+    ordered = get_setting("ETL_TRANSFORM_ORDERED", "True").capitalize() == "True"
+    return incremental, not incremental and (workers <= 1 or ordered)
+
+
+def transform_chunk(chunk, skip=0):
+    """Return the vehicles in a standalone document cut from the data dump,
+    but the first skip, and the stage totals profiled while transforming them.
+
+    Run in the worker processes of ``Transform.build_in_parallel''."""
+    take()
+    piece = int(get_setting("ETL_READ_CHUNK_SIZE", "1048576"))
+    pieces = (chunk[start : start + piece] for start in range(0, len(chunk), piece))
+    return list(Transform.vehicles(pull_events(pieces), skip)), take()
 
 
 class Extract:
@@ -73,9 +164,18 @@ class Extract:
         if self.ftp:
             self.ftp.close()
 
+    def connect(self):
+        """Open and return a new FTPHost connected to the DMR."""
+        ftp_conn_data = self.get_ftp_connection_data()
+        return ftp_conn_data and ftp_connect(**ftp_conn_data)
+
     def download_if_newer(self):
         """Download latest zipped dump from the DMR
-        if newer than the last downloaded."""
+        if newer than the last downloaded.
+
+        Interrupted downloads are resumed where they left off; see ``ftp_download''.
+        If ``ETL_STREAM_FROM_FTP'' is set, nothing is downloaded up front;
+        a seekable stream over the remote file is returned instead."""
 
         newest_file = ls_lt(self.ftp)[-1]
         filename = newest_file[1]
@@ -85,6 +185,10 @@ class Extract:
         # return "./tests/testdata/testdata_dk.zip", last_modified
         # return "C:/Temp/ESStatistikListeModtag-20181015-070837.zip", last_modified
         if newer_than_latest(DK, last_modified):
+            if get_setting("ETL_STREAM_FROM_FTP", "False").capitalize() == "True":
+                LOG.info("Streaming %s (%.1f GB)", filename, filesize / 1024 ** 3)
+                remote = FTPReader(self.connect, filename, filesize)
+                return BufferedReader(remote, MAX_COPY_CHUNK_SIZE), last_modified
             if filesize > disk_usage(gettempdir()).free:
                 raise OSError(
                     ENOSPC,
@@ -94,8 +198,22 @@ class Extract:
             target = path_join(gettempdir(), filename)
             indicator = "%(percent).1f%% (done in %(eta_td)s)"
             progbar = Bar(f"Downloading {filename}", max=chunks, suffix=indicator)
+            lock = Lock()
+
+            def progress(_chunk):
+                with lock:
+                    progbar.next()
+
             LOG.info("Downloading %s (%.1f GB)", filename, filesize / 1024 ** 3)
-            self.ftp.download(filename, target, lambda chunk: progbar.next())
+            with stage("download"):
+                ftp_download(
+                    self.connect,
+                    filename,
+                    target,
+                    filesize,
+                    segments=int(get_setting("ETL_FTP_SEGMENTS", "1")),
+                    callback=progress,
+                )
             progbar.finish()
             return target, last_modified
         return False, t_0()
@@ -133,73 +251,183 @@ class Extract:
 
     def open_dmr_ftp(self):
         """Connect to the DMR FTP server and set the FTPHost."""
-        ftp_conn_data = self.get_ftp_connection_data()
-        self.ftp = ftp_conn_data and ftp_connect(**ftp_conn_data)
+        self.ftp = self.connect()
 
 
 class Transform:
-    """Methods to transform extracted data into loadable form."""
+    """Methods to transform extracted data into loadable form.
+
+    The dump may be given as a path or as a seekable binary file object."""
+
+    offset = 0
+    size = None
 
     def __init__(self, path_to_dump):
         self.dump = path_to_dump
 
-    @snoop
-    def build_from_xml(self):
-        """Return a list of entities from the data dump."""
+    def build_from_xml(self, skip=0):
+        """Yield entities from the data dump one at a time, but the first skip.
+
+        Each ``Statistik'' element is discarded as soon as its vehicle has been
+        built, so memory use stays flat regardless of the size of the dump.
+        If ``ETL_TRANSFORM_WORKERS'' is greater than 1, the dump is transformed
+        by that many processes; see ``build_in_parallel''."""
+        workers = int(get_setting("ETL_TRANSFORM_WORKERS", "1"))
+        if workers > 1:
+            yield from self.build_in_parallel(workers, skip)
+        else:
+            yield from self.vehicles(self.xml_pull_events(), skip)
+
+    def build_in_parallel(self, workers, skip=0):
+        """Yield entities from the data dump, transformed by a pool of processes.
+
+        The dump is cut into documents of about ``ETL_TRANSFORM_CHUNK_SIZE''
+        bytes by ``statistik_chunks'', each of which is transformed by a worker.
+        At most two documents per worker are in flight; beyond that, reading
+        the dump waits. Vehicles are yielded in the order of the dump, unless
+        ``ETL_TRANSFORM_ORDERED'' is False, in which case the vehicles of each
+        document are yielded as soon as it has been transformed. Documents
+        holding only vehicles to skip are not transformed at all."""
+        size = int(get_setting("ETL_TRANSFORM_CHUNK_SIZE", "16777216"))
+        ordered = get_setting("ETL_TRANSFORM_ORDERED", "True").capitalize() == "True"
+        pending = deque()
+
+        def done():
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+                pending.remove(future)
+            vehicles, stages = future.result()
+            merge(stages)
+            return vehicles
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk in self.statistik_chunks(size):
+                if skip:
+                    count = len(STATISTIK_START.findall(chunk))
+                    if count <= skip:
+                        skip -= count
+                        continue
+                if len(pending) >= 2 * workers:
+                    yield from done()
+                pending.append(pool.submit(transform_chunk, chunk, skip))
+                skip = 0
+            while pending:
+                yield from done()
+
+    def statistik_chunks(self, size):
+        """Yield the data dump as standalone XML documents of at least size bytes.
+
+        Each document repeats the header of the dump up to its first
+        ``Statistik'' element, and with it the namespace declarations, followed
+        by whole ``Statistik'' elements and the end tags closing the header.
+        Raises ValueError if the first ``Statistik'' element is not found within
+        size bytes, as when the dump uses a namespace prefix other than
+        ``DMR_PREFIX''."""
+        header = footer = None
+        buffer = bytearray()
+        for data in self.xml_chunks("Splitting XML dump"):
+            buffer += data
+            if header is None:
+                first = STATISTIK_START.search(buffer)
+                if first is None:
+                    if len(buffer) < size:
+                        continue
+                    break
+                header = bytes(buffer[: first.start()])
+                footer = closing_tags(header)
+                del buffer[: first.start()]
+            while len(buffer) >= size:
+                cut = STATISTIK_START.search(buffer, size)
+                if cut is None:
+                    break
+                yield header + buffer[: cut.start()] + footer
+                del buffer[: cut.start()]
+        if header is None:
+            raise ValueError(
+                f"Did not find <{DMR_PREFIX}:Statistik> near the start of the dump"
+            )
+        yield header + buffer
+
+    @staticmethod
+    def vehicles(events, skip=0):
+        """Yield a ``VehicleRecord'' per ``Statistik'' element in XML parser events,
+        but for the first skip, which are only discarded."""
         nsmap = {}
-        entities = []
+        statistik = extract = None
+        tostring = timed("serialize", etree.tostring)
 
-        for event, elem in self.xml_pull_events():
+        for event, elem in events:
             if event == "start-ns":
                 namespace, url = elem
                 nsmap[namespace] = url
-            if event == "end":
-                if elem.tag == f'{{{nsmap["ns"]}}}Statistik':
-                    vehicle = Vehicle(
+                if namespace == DMR_PREFIX:
+                    statistik = f"{{{url}}}Statistik"
+                    extract = timed("extract", node_text_extractor(NODE_NAMES, nsmap))
+            if event == "end" and elem.tag == statistik:
+                if skip:
+                    skip -= 1
+                else:
+                    text = extract(elem)
+                    vehicle = VehicleRecord(
                         country=DK,
-                        plate=get_node_text(elem, "RegistreringNummerNummer", nsmap),
-                        first_reg=get_node_text(
-                            elem, "KoeretoejOplysningFoersteRegistreringDato", nsmap
+                        plate=text["RegistreringNummerNummer"],
+                        first_reg=parse_date(
+                            text["KoeretoejOplysningFoersteRegistreringDato"]
                         ),
-                        vin=get_node_text(elem, "KoeretoejOplysningStelNummer", nsmap),
-                        maker=get_node_text(elem, "KoeretoejMaerkeTypeNavn", nsmap),
+                        vin=text["KoeretoejOplysningStelNummer"],
+                        maker=text["KoeretoejMaerkeTypeNavn"],
                         model="{} {}".format(
-                            get_node_text(elem, "KoeretoejModelTypeNavn", nsmap),
-                            get_node_text(elem, "KoeretoejVariantTypeNavn", nsmap),
+                            text["KoeretoejModelTypeNavn"],
+                            text["KoeretoejVariantTypeNavn"],
                         ),
-                        fuel_type=get_node_text(elem, "DrivkraftTypeNavn", nsmap),
-                        colour=get_node_text(elem, "FarveTypeNavn", nsmap),
-                        raw_xml=etree.tostring(elem, encoding="unicode"),
+                        fuel_type=text["DrivkraftTypeNavn"],
+                        colour=text["FarveTypeNavn"],
+                        raw_xml=tostring(elem, encoding="unicode", with_tail=False),
+                        ident=text["KoeretoejIdent"] or None,
                     )
                     LOG.debug(vehicle)
-                    entities.append(vehicle)
-                    elem.clear()
-        return entities
+                    yield vehicle
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
 
-    def xml_pull_events(self):
-        """Return a list of XML parser events from the data dump."""
-        parser = etree.XMLPullParser(["start-ns", "end"])
-        spinner = Spinner("Parsing XML dump … ")
-        spinner.next()
+    def xml_chunks(self, label):
+        """Yield the data dump as raw bytes, ``ETL_READ_CHUNK_SIZE'' at a time.
+
+        Progress is reported under label once per chunk, and the number of
+        bytes read so far kept in ``offset''. Reading a chunk is profiled as
+        the ``decompress'' stage."""
+        chunk_size = int(get_setting("ETL_READ_CHUNK_SIZE", "1048576"))
         with self.xml_stream() as instream:
-            for _, line in enumerate(instream):
-                spinner.next()
-                parser.feed(line)
-            print("\bdone.")
-            parser.close()
-            spinner.finish()
-            return parser.read_events()
+            read = timed("decompress", instream.read)
+            progbar = Bar(
+                label, max=self.size, suffix="%(percent).1f%% (done in %(eta_td)s)"
+            )
+            self.offset = 0
+            for chunk in iter(lambda: read(chunk_size), b""):
+                self.offset += len(chunk)
+                yield chunk
+                progbar.next(len(chunk))
+            progbar.finish()
+
+    def xml_pull_events(self):
+        """Yield XML parser events from the data dump as soon as they are parsed.
+
+        The dump is fed to the parser as raw bytes in large chunks, leaving
+        decoding to lxml; see ``xml_chunks'' and ``pull_events''."""
+        return pull_events(self.xml_chunks("Parsing XML dump"))
 
     def xml_stream(self):
-        """Open one-file archive and return a buffered stream
-        suitable for plugging into a pull parser."""
+        """Open one-file archive and return a binary stream of its contents,
+        suitable for feeding into a pull parser."""
         if is_zipfile(self.dump):
             with ZipFile(self.dump, "r") as zipf:
                 infolist = zipf.infolist()
                 if len(infolist) == 1:
-                    return TextIOWrapper(
-                        zipf.open(infolist[0].filename, "r"), encoding="utf-8"
-                    )
+                    self.size = infolist[0].file_size
+                    return zipf.open(infolist[0].filename, "r")
         LOG.error("Could not open %s as XML stream!", self.dump)
         return None
 
@@ -1,12 +1,400 @@
 """Utility methods for ETL routines."""
 
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from errno import EIO
+from gzip import open as gzip_open
+from hashlib import blake2b
+from io import SEEK_CUR, SEEK_END, SEEK_SET, RawIOBase
+from itertools import islice
+from json import dumps, loads
+from os import curdir, getpid, makedirs, remove, replace, strerror
+from os.path import basename, dirname, exists, getsize, join as path_join
+from shutil import copyfileobj
+from socket import gethostname
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+from uuid import uuid4
 from warnings import warn
 
+from elasticsearch.exceptions import ConflictError, RequestError, TransportError
+from elasticsearch.helpers import scan, streaming_bulk
+from elasticsearch.serializer import JSONSerializer
 from ftputil import FTPHost
 from ftputil.error import FTPOSError
+from ftputil.file_transfer import MAX_COPY_CHUNK_SIZE
+from lxml import etree  # nosec <https://github.com/PyCQA/bandit/issues/435>
+from pytz import utc
 
-from plateypus.helpers import elastic, t_0
-from plateypus.models import Metadata, Vehicle
+from plateypus.etl.profiling import stage_consuming, timed
+from plateypus.helpers import elastic, get_setting, init_logger, t_0
+from plateypus.models import (
+    INDEX_VEHICLES,
+    Metadata,
+    Run,
+    Vehicle,
+    country_alias,
+    vehicle_index,
+)
+
+ARTIFACT_SUFFIX = ".ndjson.gz"
+ARTIFACT_TIME_FORMAT = "%Y%m%dT%H%M%S%z"
+BULK_LOAD_SETTINGS = {"index.refresh_interval": "-1", "index.number_of_replicas": 0}
+LOG = init_logger(__name__)
+
+
+class FTPReader(RawIOBase):
+    """Seekable, read-only file object over a file on an FTP server.
+
+    Sequential reads are served from a single transfer; reading from any
+    other offset (re)opens the transfer there. This is enough for
+    ``ZipFile'', which only seeks to read the central directory at the
+    end of the archive before reading a member front to back. Dropped
+    connections are resumed up to ``ETL_FTP_RETRIES'' times."""
+
+    def __init__(self, connect, path, size):
+        super().__init__()
+        self.connect = connect
+        self.path = path
+        self.size = size
+        self.pos = 0
+        self.ftp = self.remote = self.remote_pos = None
+
+    def close(self):
+        self.disconnect()
+        super().close()
+
+    def disconnect(self):
+        """Close the current transfer and connection, if any."""
+        if self.remote is not None:
+            self.remote.close()
+        if self.ftp is not None:
+            self.ftp.close()
+        self.ftp = self.remote = self.remote_pos = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.pos >= self.size:
+            return 0
+        retries = int(get_setting("ETL_FTP_RETRIES", "5"))
+        for attempt in range(retries + 1):
+            try:
+                if self.remote_pos != self.pos:
+                    self.disconnect()
+                    self.ftp = self.connect()
+                    if self.ftp is None:
+                        raise FTPOSError("Could not connect to FTP server")
+                    self.remote = self.ftp.open(self.path, "rb", rest=self.pos)
+                    self.remote_pos = self.pos
+                data = self.remote.read(len(buffer))
+                break
+            except OSError as err:
+                if attempt == retries:
+                    raise
+                LOG.warning("Reading %s failed: %s", self.path, err)
+                self.disconnect()
+                sleep(min(2 ** attempt, 60))
+        buffer[: len(data)] = data
+        self.pos += len(data)
+        self.remote_pos = self.pos
+        return len(data)
+
+    def seek(self, offset, whence=SEEK_SET):
+        self.pos = {SEEK_SET: 0, SEEK_CUR: self.pos, SEEK_END: self.size}[
+            whence
+        ] + offset
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+
+class RunLedger:  # pylint: disable=too-many-instance-attributes
+    """The ledger of an ETL run for a country, kept in the ``Metadata'' of country.
+
+    The ledger doubles as a lock: only the run that acquired it may write to
+    it, until it is released, or until its heartbeat is older than
+    ``ETL_LOCK_TIMEOUT'' seconds, as happens when the run holding it dies.
+    Every write is conditional on the sequence number of the document, so
+    two runs can never both take it over. While held, the heartbeat is
+    renewed in the background.
+
+    ``bytes_read'' may be set to a callable returning how much of the dump
+    has been read, which is recorded with each checkpoint; by default, no
+    byte offset is recorded."""
+
+    def __init__(self, country):
+        self.country = country
+        self.owner = f"{gethostname()}:{getpid()}:{uuid4().hex}"
+        self.meta = None
+        self.previous = {}
+        self.run = {}
+        self.resume_from = 0
+        self.bytes_read = lambda: None
+        self.lock = Lock()
+        self.released = Event()
+        self.timeout = float(get_setting("ETL_LOCK_TIMEOUT", "3600"))
+
+    def acquire(self):
+        """Take the ledger for a new run, and return whether that succeeded."""
+        with elastic() as client:
+            meta = self.fetch(client)
+            previous = meta.run.to_dict() if meta else {}
+            started = datetime.now(utc)
+            if meta and meta.run.owner:
+                heartbeat = meta.run.heartbeat or t_0()
+                if heartbeat + timedelta(seconds=self.timeout) > started:
+                    LOG.warning("%s is held by %s.", self.country, meta.run.owner)
+                    return False
+            run = dict(
+                previous,
+                owner=self.owner,
+                heartbeat=started,
+                started=started,
+                stage="start",
+            )
+            try:
+                if meta is None:
+                    meta = Metadata(
+                        meta=dict(id=self.country),
+                        country=self.country,
+                        last_updated=t_0(),
+                        run=Run(**run),
+                    )
+                    meta.save(using=client, op_type="create", refresh=True)
+                else:
+                    meta.run = Run(**run)
+                    meta.save(using=client, refresh=True)
+            except ConflictError:
+                return False
+        self.meta, self.previous, self.run = meta, previous, run
+        Thread(target=self.beat, name=f"ledger-{self.country}", daemon=True).start()
+        return True
+
+    def beat(self):
+        """Renew the heartbeat until the ledger is released."""
+        while not self.released.wait(self.timeout / 4):
+            try:
+                self.update()
+            except ConflictError:
+                LOG.error("Lost the ledger of %s to another run.", self.country)
+                return
+            except TransportError as error:
+                LOG.warning("Could not renew the ledger of %s: %s", self.country, error)
+
+    def begin(self, dump, resumable=True):
+        """Record that dump is about to be loaded, and return the number of its
+        vehicles to skip because an interrupted run already indexed them.
+
+        If resumable, a run is resumed if it was loading the same dump into
+        an index that still exists, and was neither done nor failed. The
+        index of an unfinished run that is not resumed is deleted."""
+        previous = self.previous
+        index = self.unfinished_index()
+        with elastic() as client:
+            if not (index and client.indices.exists(index=index)):
+                index = None
+            elif resumable and previous.get("dump") == dump:
+                self.resume_from = previous.get("record_offset") or 0
+                LOG.info("Resuming %s after %d vehicles.", index, self.resume_from)
+            else:
+                alias = country_alias(self.country)
+                if not client.indices.exists_alias(name=alias, index=index):
+                    LOG.info("Deleting %s, left unfinished by a previous run.", index)
+                    client.indices.delete(index=index)
+                index = None
+        self.update(
+            dump=dump,
+            stage="transform",
+            index=index,
+            byte_offset=None,
+            record_offset=self.resume_from,
+            indexed=None,
+            failed=None,
+        )
+        return self.resume_from
+
+    def checkpoint(self, records):
+        """Record that the first records vehicles loaded by this run are indexed."""
+        self.update(
+            record_offset=self.resume_from + records, byte_offset=self.bytes_read()
+        )
+
+    def fetch(self, client):
+        """Return the current ``Metadata'' of country, or None if there is none."""
+        search = Metadata.search(using=client).filter("term", country=self.country)
+        hits = search[:1].execute()
+        return Metadata.get(id=hits[0].meta.id, using=client) if hits else None
+
+    def release(self, stage):
+        """Record the final stage of the run, and give up the ledger."""
+        self.released.set()
+        try:
+            self.update(stage=stage, owner=None)
+        except ConflictError:
+            LOG.error("Lost the ledger of %s to another run.", self.country)
+
+    def unfinished_index(self):
+        """Return the index the previous run left unfinished, or None if it finished."""
+        if self.previous.get("stage") in ("done", "failed"):
+            return None
+        return self.previous.get("index")
+
+    def update(self, **fields):
+        """Record fields in the ledger, and renew the heartbeat.
+
+        Raise ``ConflictError'' if another run has taken over the ledger."""
+        with self.lock, elastic() as client:
+            run = dict(self.run, **fields, heartbeat=datetime.now(utc))
+            self.meta.run = Run(**run)
+            try:
+                self.meta.save(using=client, refresh=True)
+            except ConflictError:  # e.g. last_updated was upserted meanwhile
+                self.meta = self.fetch(client)
+                if self.meta is None or self.meta.run.owner != self.owner:
+                    raise
+                self.meta.run = Run(**run)
+                self.meta.save(using=client, refresh=True)
+            self.run = run
+
+
+def artifact_details(path):
+    """Return the country and the time last updated of the artifact at path."""
+    country, timestamp = basename(path)[: -len(ARTIFACT_SUFFIX)].rsplit("-", 1)
+    return country, datetime.strptime(timestamp, ARTIFACT_TIME_FORMAT)
+
+
+def artifact_path(country, last_updated):
+    """Return where to write the artifact of the data dump of country last updated
+    at the given time, or None if ``ETL_ARTIFACT_DIR'' is not set."""
+    directory = get_setting("ETL_ARTIFACT_DIR")
+    if not directory:
+        return None
+    timestamp = last_updated.astimezone(utc).strftime(ARTIFACT_TIME_FORMAT)
+    return path_join(directory, f"{country}-{timestamp}{ARTIFACT_SUFFIX}")
+
+
+@contextmanager
+def bulk_indexing(client, index):
+    """Disable refresh and replicas on the given index for the duration of a bulk load.
+
+    The previous settings are restored, and the index refreshed, on exit."""
+    current = client.indices.get_settings(
+        index=index, name=list(BULK_LOAD_SETTINGS), flat_settings=True
+    )
+    client.indices.put_settings(index=index, body=BULK_LOAD_SETTINGS)
+    try:
+        yield client
+    finally:
+        for name, cfg in current.items():
+            restore = {key: cfg["settings"].get(key) for key in BULK_LOAD_SETTINGS}
+            client.indices.put_settings(index=name, body=restore)
+        client.indices.refresh(index=index)
+
+
+def bulk_load(client, actions, checkpoint=None):  # pylint: disable=too-many-locals
+    """Send bulk actions to Elasticsearch, logging throughput per chunk.
+
+    Rejected items are retried with exponential backoff. If more than one
+    worker is configured, chunks are sent concurrently. Return the number
+    of items indexed and the number of items that ultimately failed.
+    Time spent waiting for Elasticsearch is profiled as the ``index'' stage.
+
+    If given, checkpoint is called every ``ETL_CHECKPOINT_INTERVAL'' items
+    with a number of leading actions that have certainly been processed.
+    With concurrent workers, that is the actions of the chunks completed
+    in the order they were sent, so it lags behind a slow chunk."""
+    options = bulk_options()
+    chunk_size = options["chunk_size"]
+    workers = int(get_setting("ETL_BULK_WORKERS", "1"))
+    interval = int(get_setting("ETL_CHECKPOINT_INTERVAL", "100000"))
+    started = last = perf_counter()
+    count = failed = 0
+    completed = Counter()
+
+    with stage_consuming("index", actions) as consumed:
+        if workers > 1:
+            queue_size = int(get_setting("ETL_BULK_QUEUE_SIZE", str(workers)))
+            results = bulk_load_parallel(
+                client, consumed, workers, queue_size, completed, **options
+            )
+        else:
+            results = streaming_bulk(client, consumed, raise_on_error=False, **options)
+        for count, (okay, item) in enumerate(results, start=1):
+            if not okay:
+                failed += 1
+                LOG.warning("Bulk item failed: %s", item)
+            if checkpoint and count % interval == 0:
+                checkpoint(completed["actions"] if workers > 1 else count)
+            if count % chunk_size == 0:
+                now = perf_counter()
+                LOG.info(
+                    "Indexed %d docs (%.0f docs/s)", count, chunk_size / (now - last)
+                )
+                last = now
+    elapsed = perf_counter() - started
+    LOG.info(
+        "Indexed %d docs in %.1fs (%.0f docs/s)", count, elapsed, count / (elapsed or 1)
+    )
+    return count - failed, failed
+
+
+def bulk_load_parallel(  # pylint: disable=too-many-arguments,too-many-locals
+    client, actions, workers, queue_size, completed=None, **options
+):
+    """Yield bulk results from a pool of threads sending chunks concurrently.
+
+    Up to ``workers`` bulk requests are in flight at any time, and at most
+    ``queue_size`` further chunks are buffered; beyond that, consumption
+    of ``actions`` blocks until a request completes. Results are yielded
+    in order of completion. If given, the Counter completed is kept at the
+    number of leading ``actions`` whose chunks have all completed."""
+
+    def send(chunk):
+        return list(streaming_bulk(client, chunk, raise_on_error=False, **options))
+
+    def results(done):
+        while sent and sent[0][1].done() and sent[0][1].exception() is None:
+            completed["actions"] = sent.popleft()[0]
+        for future in done:
+            yield from future.result()
+
+    completed = Counter() if completed is None else completed
+    actions = iter(actions)
+    chunks = iter(lambda: list(islice(actions, options["chunk_size"])), [])
+    pending = set()
+    sent = deque()
+    offset = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk") as pool:
+        for chunk in chunks:
+            while len(pending) >= workers + queue_size:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from results(done)
+            offset += len(chunk)
+            future = pool.submit(send, chunk)
+            sent.append((offset, future))
+            pending.add(future)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from results(done)
+
+
+def bulk_options():
+    """Return keyword arguments for the bulk helpers, read from env settings."""
+    return dict(
+        chunk_size=int(get_setting("ETL_BULK_CHUNK_SIZE", "500")),
+        max_chunk_bytes=int(get_setting("ETL_BULK_MAX_BYTES", "10485760")),
+        max_retries=int(get_setting("ETL_BULK_MAX_RETRIES", "5")),
+        initial_backoff=int(get_setting("ETL_BULK_INITIAL_BACKOFF", "2")),
+        max_backoff=int(get_setting("ETL_BULK_MAX_BACKOFF", "600")),
+    )
 
 
 def clean_vehicles(country):
@@ -18,6 +406,36 @@ def clean_vehicles(country):
         return count
 
 
+def closing_tags(header):
+    """Return the end tags, as bytes, of the elements left open by an XML header.
+
+    Appending them to the header and any complete elements following it
+    makes a well-formed document."""
+    parser = etree.XMLPullParser(["start", "end"])
+    parser.feed(header)
+    open_elems = []
+    for event, elem in parser.read_events():
+        if event == "start":
+            open_elems.append(elem)
+        else:
+            open_elems.pop()
+    tags = []
+    for elem in reversed(open_elems):
+        name = etree.QName(elem).localname
+        tags.append(f"</{elem.prefix}:{name}>" if elem.prefix else f"</{name}>")
+    return "".join(tags).encode()
+
+
+def create_vehicle_index(client, country):
+    """Create a new, empty, timestamped vehicle index for country and return its name.
+
+    The index is not visible to searches until ``swap_vehicle_index'' is called."""
+    stamp = datetime.now(utc).strftime("%Y%m%d%H%M%S%f")
+    name = f"{country_alias(country)}-{stamp}"
+    vehicle_index(name).create(using=client)
+    return name
+
+
 def ftp_connect(server, user, passwd, cwd):
     """Connect to an FTP server, change working dir and return FTPHost object."""
     try:
@@ -28,6 +446,90 @@ def ftp_connect(server, user, passwd, cwd):
         return None
 
 
+def ftp_download(  # pylint: disable=too-many-arguments,too-many-locals
+    connect, source, target, size, segments=1, callback=None
+):
+    """Download source from an FTP server into target, resuming earlier attempts.
+
+    The file is fetched as ``segments'' byte ranges in parallel, each over
+    its own connection returned by ``connect'' and into its own ``.part''
+    file. The parts are joined once all of them are complete; incomplete
+    parts are kept for the next attempt. Raise ``OSError'' if a part could
+    not be completed, or the file does not have the expected size."""
+    if exists(target) and getsize(target) == size:
+        LOG.info("%s already downloaded.", target)
+        return target
+    bounds = [size * num // segments for num in range(segments + 1)]
+    parts = [f"{target}.{segments}.part{num}" for num in range(segments)]
+    ranges = list(zip(parts, bounds, bounds[1:]))
+    if segments == 1:
+        ftp_fetch_range(connect, source, *ranges[0], callback)
+    else:
+        with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="ftp") as pool:
+            futures = [
+                pool.submit(ftp_fetch_range, connect, source, *rng, callback)
+                for rng in ranges
+            ]
+            for future in futures:
+                future.result()
+    incomplete = [
+        part
+        for part, first, last in ranges
+        if (getsize(part) if exists(part) else 0) != last - first
+    ]
+    if incomplete:
+        raise OSError(EIO, strerror(EIO), f"Incomplete download: {incomplete}")
+    with open(parts[0], "ab") as whole:
+        for part in parts[1:]:
+            with open(part, "rb") as piece:
+                copyfileobj(piece, whole, MAX_COPY_CHUNK_SIZE)
+            remove(part)
+    if getsize(parts[0]) != size:
+        remove(parts[0])
+        raise OSError(EIO, strerror(EIO), f"{target} is not {size} bytes")
+    replace(parts[0], target)
+    return target
+
+
+def ftp_fetch_range(  # pylint: disable=too-many-arguments
+    connect, source, part, start, end, callback=None
+):
+    """Fetch bytes ``start'' through ``end - 1'' of source into the file part.
+
+    Whatever is already in part is kept, and fetching continues from the
+    offset following it, so an interrupted range can be resumed. On a
+    connection error, reconnect and resume up to ``ETL_FTP_RETRIES'' times."""
+    retries = int(get_setting("ETL_FTP_RETRIES", "5"))
+    for attempt in range(retries + 1):
+        done = getsize(part) if exists(part) else 0
+        if done > end - start:
+            done = 0
+        if done == end - start:
+            return
+        ftp = connect()
+        try:
+            if ftp is None:
+                raise FTPOSError("Could not connect to FTP server")
+            with ftp.open(source, "rb", rest=start + done) as remote, open(
+                part, "ab" if done else "wb"
+            ) as local:
+                remaining = end - start - done
+                while remaining > 0:
+                    chunk = remote.read(min(MAX_COPY_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    local.write(chunk)
+                    remaining -= len(chunk)
+                    if callback:
+                        callback(chunk)
+        except OSError as err:
+            LOG.warning("Fetching %s failed (attempt %d): %s", part, attempt + 1, err)
+            sleep(min(2 ** attempt, 60))
+        finally:
+            if ftp is not None:
+                ftp.close()
+
+
 def get_node_text(elem, node_name, nsmap):
     """Return any text inside the given XML node."""
     xpath = f".//ns:{node_name}"
@@ -40,18 +542,129 @@ def get_node_text(elem, node_name, nsmap):
     return elem.findtext(xpath, namespaces=nsmap)
 
 
-def load_vehicles(country, vehicles, last_updated):
-    """Load list of vehicles from given country into database."""
-    clean_vehicles(country)
+def index_sizes(client, index):
+    """Return the size in bytes of the primary shards of each index matching index."""
+    stats = client.indices.stats(index=index, metric="store")["indices"]
+    return {
+        name: stat["primaries"]["store"]["size_in_bytes"]
+        for name, stat in stats.items()
+    }
+
+
+def load_fresh_index(country, actions, last_updated, ledger=None, spare=None):
+    """Bulk load the actions returned by ``actions(index)'' into a fresh index,
+    and make it the live index of country if every action succeeded.
+
+    If a ``RunLedger'' is given, the load is checkpointed in it; if it is
+    resuming an interrupted load, the index of that load is completed
+    instead of a fresh one. The index named spare, if any, is not deleted
+    along with the replaced indices; see ``swap_vehicle_index''."""
+    resumed = ledger.resume_from if ledger else 0
+    with elastic() as client:
+        if resumed:
+            index = ledger.run["index"]
+            client.indices.put_settings(
+                index=index, body={key: None for key in BULK_LOAD_SETTINGS}
+            )
+        else:
+            index = create_vehicle_index(client, country)
+        if ledger:
+            ledger.update(stage="load", index=index)
+        with bulk_indexing(client, index):
+            indexed, failed = bulk_load(
+                client, actions(index), ledger.checkpoint if ledger else None
+            )
+        stored = client.count(index=index)["count"]
+        if ledger:
+            ledger.update(indexed=resumed + indexed, failed=failed)
+        if failed or stored != resumed + indexed:
+            LOG.error(
+                "%d vehicles could not be indexed, %d of %d found in %s.",
+                failed,
+                stored,
+                resumed + indexed,
+                index,
+            )
+            client.indices.delete(index=index)
+            if ledger:
+                ledger.update(stage="failed")
+            return False
+        swap_vehicle_index(client, country, index, spare)
+
+    upsert_metadata(country, last_updated)
+    return True
+
+
+def load_vehicle_deltas(country, vehicles, last_updated, artifact=None):
+    """Apply only the differences between vehicles and the live index for country.
 
+    Vehicles whose content hash matches the one in the live index are
+    skipped, and vehicles no longer present are deleted. If country has no
+    live index yet, or its mapping cannot be updated in place (e.g. because
+    it lacks analyzers added since it was created), fall back to a full
+    ``load_vehicles''. If an artifact path is given, all vehicles, changed
+    or not, are also written to it; see ``write_artifact''.
+
+    The id and content hash of every live vehicle are held in memory while
+    comparing, which takes about 200 bytes per vehicle, or several GB for
+    the full DMR. Use full loads where that is too much."""
+    alias = country_alias(country)
     with elastic() as client:
-        for vehicle in vehicles:
-            vehicle.save(using=client)
+        if not client.indices.exists_alias(name=alias):
+            LOG.info("No live index for %s, doing a full load.", country)
+            return load_vehicles(country, vehicles, last_updated, artifact)
+        index = vehicle_index(alias)
+        try:
+            index.put_mapping(using=client, body=index.to_dict()["mappings"])
+        except RequestError as error:
+            LOG.info(
+                "Cannot update mapping of %s (%s), doing a full load.", alias, error
+            )
+            return load_vehicles(country, vehicles, last_updated, artifact)
+        search = Vehicle.search(using=client, index=alias).source(["content_hash"])
+        known = {hit.meta.id: hit.content_hash for hit in search.scan()}
+        counts = Counter()
+        _, failed = bulk_load(
+            client, vehicle_deltas(alias, vehicles, known, counts, artifact)
+        )
+        client.indices.refresh(index=alias)
 
+    LOG.info(
+        "%s: %d created, %d updated, %d deleted, %d unchanged.",
+        alias,
+        counts["created"],
+        counts["updated"],
+        counts["deleted"],
+        counts["unchanged"],
+    )
+    if failed:
+        LOG.error("%d vehicle changes could not be applied.", failed)
+        return False
     upsert_metadata(country, last_updated)
     return True
 
 
+def load_vehicles(country, vehicles, last_updated, artifact=None, ledger=None):
+    """Load vehicles from given country into database.
+
+    ``vehicles`` may be any iterable, e.g. the generator returned by a
+    ``Transform``; it is consumed lazily and never materialised. Vehicles
+    are sent in chunks through the bulk API into a fresh index, which only
+    replaces the live index for country once every vehicle has been indexed.
+    Until then, searches keep being served from the previous index. If an
+    artifact path is given, the vehicles are also written to it; see
+    ``write_artifact''. If a ``RunLedger'' is given, the load is checkpointed
+    in it, and vehicles already indexed by an interrupted run of the same
+    dump must have been left out; see ``load_fresh_index''."""
+
+    def actions(index):
+        action = timed("serialize", vehicle_action)
+        actions = (action(index, v) for v in vehicles)
+        return write_artifact(artifact, actions) if artifact else actions
+
+    return load_fresh_index(country, actions, last_updated, ledger)
+
+
 def ls_lt(ftp):
     """Return directory listing from FTP connection, sorted by time modified."""
     files = [(ftp.stat(f), f) for f in ftp.listdir(ftp.curdir)]
@@ -59,6 +672,39 @@ def ls_lt(ftp):
     return files
 
 
+def migrate_vehicles(country):
+    """Reload the live vehicles of country into a new index with the current mapping.
+
+    Vehicles are read back from the live index rather than from a new data
+    dump, so mapping changes can be applied right away. The time the
+    vehicles of country were last updated is kept. Like an ETL run, this
+    takes the ``run_ledger'' of country, and gives up if another run holds it.
+    An index left unfinished by an interrupted run is kept for it to resume."""
+    alias = country_alias(country)
+
+    def vehicles(client):
+        for hit in scan(client, index=alias):
+            source = hit["_source"]
+            source["first_reg"] = parse_date(source.get("first_reg"))
+            yield Vehicle(**source)
+
+    with run_ledger(country) as ledger, elastic() as client:
+        if ledger is None:
+            LOG.info("Another run is loading %s. Not migrating it.", country)
+            return False
+        if not client.indices.exists_alias(name=alias):
+            LOG.info("No live index for %s, nothing to migrate.", country)
+            return False
+        meta = Metadata.search(using=client).filter("term", country=country)
+        last_updated = meta.execute()[0].last_updated if meta.count() else t_0()
+        return load_fresh_index(
+            country,
+            lambda index: (vehicle_action(index, v) for v in vehicles(client)),
+            last_updated,
+            spare=ledger.unfinished_index(),
+        )
+
+
 def newer_than_latest(country, timestamp):
     """Check whether the given timestamp is newer than the last downloaded dump for country."""
     last_updated = t_0()
@@ -71,6 +717,161 @@ def newer_than_latest(country, timestamp):
     return timestamp > last_updated
 
 
+def node_text_extractor(node_names, nsmap):
+    """Return a function extracting the text of all the given nodes inside an element.
+
+    The returned function walks the element once, in C, visiting only the
+    wanted nodes, and returns a dict mapping each node name to its text.
+    Like ``get_node_text'', it warns about missing and repeated nodes and
+    only keeps the text of the first of each."""
+    uri = nsmap["ns"]
+    tags = {f"{{{uri}}}{node_name}": node_name for node_name in node_names}
+
+    def extract(elem):
+        texts = {}
+        repeats = Counter()
+        for node in elem.iterdescendants(*tags):
+            node_name = tags[node.tag]
+            if node_name in texts:
+                repeats[node_name] += 1
+            else:
+                texts[node_name] = node.text or ""
+        for node_name in node_names:
+            if node_name not in texts:
+                warn(f"Did not find {node_name}")
+                texts[node_name] = ""
+        for node_name, count in repeats.items():
+            warn(
+                f"Found {count + 1} {node_name} nodes, only returning text of the first."
+            )
+        return texts
+
+    return extract
+
+
+def parse_date(text):
+    """Return the calendar date of an ISO 8601 date, e.g. ``2010-08-16+02:00''.
+
+    Any time or UTC offset following the date is ignored. Return ``None'' if
+    text is empty or not a date."""
+    text = (text or "").strip()
+    if not text:
+        return None
+    try:
+        return date.fromisoformat(text[:10])
+    except ValueError:
+        warn(f"Could not parse date from {text!r}")
+        return None
+
+
+def pull_events(pieces):
+    """Yield ``start-ns'' and ``end'' events of the XML document fed in pieces.
+
+    Events are yielded as soon as the piece completing them has been parsed;
+    parsing a piece is profiled as the ``parse'' stage."""
+    parser = etree.XMLPullParser(["start-ns", "end"])
+    feed = timed("parse", parser.feed)
+    for piece in pieces:
+        feed(piece)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def read_artifact(index, path):
+    """Yield bulk index actions into index for the vehicles in the artifact at path.
+
+    Sources are passed on to Elasticsearch as they were serialised in the
+    artifact, without decoding them."""
+    with gzip_open(path, "rt", encoding="utf-8") as artifact:
+        for meta, source in zip(artifact, artifact):
+            yield dict(loads(meta)["index"], _index=index, _source=source[:-1])
+
+
+def replay_artifact(path):
+    """Load the vehicles in the artifact at path into a fresh index.
+
+    This works like ``load_vehicles'' with the vehicles of the data dump the
+    artifact was written from, but without extracting or transforming them.
+    Like an ETL run, this takes the ``run_ledger'' of country, and gives up
+    if another run holds it. An index left unfinished by an interrupted run
+    is kept for it to resume."""
+    country, last_updated = artifact_details(path)
+    with run_ledger(country) as ledger:
+        if ledger is None:
+            LOG.info("Another run is loading %s. Not replaying %s.", country, path)
+            return False
+        LOG.info("Replaying %s into a new index for %s.", path, country)
+        return load_fresh_index(
+            country,
+            lambda index: read_artifact(index, path),
+            last_updated,
+            spare=ledger.unfinished_index(),
+        )
+
+
+@contextmanager
+def run_ledger(country):
+    """Yield the ledger of a new ETL run for country, or None if another run holds it.
+
+    The ledger is released when the run ends. A run that began loading a
+    dump, and recorded no other stage, ends up ``done'', or ``interrupted''
+    if it raised, so that a later run of the same dump can resume where it
+    left off. A run that never began leaves the stage of the previous run."""
+    ledger = RunLedger(country)
+    if not ledger.acquire():
+        yield None
+        return
+
+    def final(ending):
+        stage = ledger.run.get("stage")
+        if stage == "start":  # nothing begun, so leave the previous run as it was
+            return ledger.previous.get("stage")
+        return ending if stage in ("transform", "load") else stage
+
+    try:
+        yield ledger
+    except BaseException:
+        ledger.release(final("interrupted"))
+        raise
+    ledger.release(final("done"))
+
+
+def swap_vehicle_index(client, country, index, spare=None):
+    """Atomically make index the live vehicle index for country.
+
+    The previous index for country, if any, is deleted afterwards, as are
+    any other indices of country but the one named spare. A legacy
+    vehicle index occupying the name of the vehicle alias is dropped in the
+    same atomic operation."""
+    alias = country_alias(country)
+    old = []
+    if client.indices.exists_alias(name=alias):
+        old = list(client.indices.get_alias(name=alias))
+    actions = [
+        dict(add=dict(index=index, alias=alias)),
+        dict(add=dict(index=index, alias=INDEX_VEHICLES)),
+    ]
+    for name in old:
+        actions.append(dict(remove=dict(index=name, alias=alias)))
+        actions.append(dict(remove=dict(index=name, alias=INDEX_VEHICLES)))
+    legacy = client.indices.exists(index=INDEX_VEHICLES)
+    if legacy and not client.indices.exists_alias(name=INDEX_VEHICLES):
+        actions.append(dict(remove_index=dict(index=INDEX_VEHICLES)))
+    client.indices.update_aliases(body=dict(actions=actions))
+    sizes = index_sizes(client, f"{alias}-*")
+    stale = [name for name in sizes if name not in (index, spare)]
+    if stale:
+        client.indices.delete(index=",".join(stale))
+    LOG.info("%s now points to %s; dropped %s", alias, index, stale)
+    LOG.info(
+        "%s takes up %d bytes, was %d bytes.",
+        alias,
+        sizes[index],
+        sum(sizes[name] for name in stale),
+    )
+
+
 def upsert_metadata(country, last_updated):
     """Upsert Metadata for the given country."""
     with elastic() as client:
@@ -79,3 +880,71 @@ def upsert_metadata(country, last_updated):
             meta.execute()[0].update(using=client, last_updated=last_updated)
         except IndexError:
             Metadata(country=country, last_updated=last_updated).save(using=client)
+
+
+def vehicle_action(index, vehicle):
+    """Return a bulk index action for vehicle, with a deterministic id and content hash.
+
+    The id is derived from country and the ``ident'' of the vehicle record,
+    so that a vehicle keeps its id from one dump to the next. VINs and plates
+    are not unique per record, so vehicles without an ident are left to get
+    an id from Elasticsearch, and cannot be matched by ``vehicle_deltas''."""
+    vehicle.clean()
+    source = vehicle.to_dict()
+    if "ident" not in source:
+        return dict(_index=index, _source=source)
+    key = f'{source["country"]}:{source["ident"]}'
+    doc_id = blake2b(key.encode(), digest_size=16).hexdigest()
+    return dict(_index=index, _id=doc_id, _source=source)
+
+
+def vehicle_deltas(index, vehicles, known, counts, artifact=None):
+    """Yield bulk actions for the vehicles that differ from the known ones.
+
+    ``known`` maps ids to content hashes of the vehicles already in index;
+    it is consumed, and whatever is left of it once vehicles is exhausted
+    is deleted. ``counts`` is updated with the number of vehicles created,
+    updated, deleted and unchanged. If an artifact path is given, actions
+    for all vehicles are written to it; see ``write_artifact''."""
+    actions = (vehicle_action(index, vehicle) for vehicle in vehicles)
+    if artifact:
+        actions = write_artifact(artifact, actions)
+    for action in actions:
+        if action.get("_id") not in known:
+            counts["created"] += 1
+        elif known.pop(action["_id"]) == action["_source"]["content_hash"]:
+            counts["unchanged"] += 1
+            continue
+        else:
+            counts["updated"] += 1
+        yield action
+    for doc_id in known:
+        counts["deleted"] += 1
+        yield dict(_op_type="delete", _index=index, _id=doc_id)
+
+
+def write_artifact(path, actions):
+    """Yield bulk index actions, writing each to the artifact at path on the way.
+
+    The artifact is a gzipped file in the NDJSON format of the bulk API, i.e.
+    an action line with the id of each vehicle, if it has one, followed by
+    its source, that
+    ``replay_artifact'' can load without parsing the data dump again. It is
+    written to a ``.part'' file, which replaces path once actions are done,
+    and is removed if they fail."""
+    part = f"{path}.part"
+    serializer = JSONSerializer()
+    makedirs(dirname(path) or curdir, exist_ok=True)
+    try:
+        with gzip_open(part, "wt", encoding="utf-8", compresslevel=6) as artifact:
+            for action in actions:
+                meta = dict(_id=action["_id"]) if "_id" in action else {}
+                artifact.write(dumps(dict(index=meta)) + "\n")
+                artifact.write(serializer.dumps(action["_source"]) + "\n")
+                yield action
+    except BaseException:
+        if exists(part):
+            remove(part)
+        raise
+    replace(part, path)
+    LOG.info("Wrote artifact %s.", path)
@@ -0,0 +1,25 @@
+"""Migrate the live vehicle indices of all countries to the current mapping."""
+
+try:  # pragma: no cover
+    from etl_utils import migrate_vehicles
+except (ImportError, ModuleNotFoundError):  # pragma: no cover
+    from plateypus.etl.etl_utils import migrate_vehicles
+finally:
+    from plateypus.helpers import elastic, init_logger
+    from plateypus.models import Metadata
+
+LOG = init_logger(__name__)
+
+
+def migrate_all():
+    """Reload the vehicles of every country with metadata into new indices."""
+    with elastic() as client:
+        countries = [meta.country for meta in Metadata.search(using=client).scan()]
+    for country in countries:
+        LOG.info("Migrating vehicles of %s.", country)
+        if not migrate_vehicles(country):
+            LOG.error("Could not migrate vehicles of %s.", country)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    migrate_all()
@@ -0,0 +1,189 @@
+"""Opt-in, low-overhead profiling of ETL stages.
+
+Profiling is off unless ``ETL_PROFILE'' is set, in which case the time spent
+in each stage of a run, and the number of times it was entered, is logged
+when the run ends. While disabled, the wrappers below return what they were
+given, so the hot loops of the transform pay nothing for them."""
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from os.path import basename
+from sys import _current_frames
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+
+from plateypus.helpers import get_setting, init_logger
+
+LOG = init_logger(__name__)
+STAGES = dict()
+STAGES_LOCK = Lock()
+
+
+class Sampler(Thread):
+    """Periodically sample the stacks of all other threads, counting each stack."""
+
+    def __init__(self, interval):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = Event()
+
+    def run(self):
+        own = get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in _current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    where = f"{basename(code.co_filename)}:{code.co_firstlineno}"
+                    stack.append(f"{code.co_name} ({where})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and wait for the sampling thread to finish."""
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        """Write the sampled stacks to path in collapsed format, one stack per line."""
+        with open(path, "w", encoding="utf-8") as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f"{stack} {count}\n")
+
+
+def enabled():
+    """Return whether ETL profiling is switched on."""
+    return get_setting("ETL_PROFILE", "False").capitalize() == "True"
+
+
+def merge(stages):
+    """Add the stage totals returned by ``take'', e.g. in another process."""
+    for name, (seconds, count) in stages.items():
+        record(name, seconds, count)
+
+
+@contextmanager
+def profiled_run(name):
+    """Profile the enclosed ETL run, if enabled, and log its stages when it ends.
+
+    If ``ETL_PROFILE_SAMPLES'' is set, the stacks of all threads are also
+    sampled every ``ETL_PROFILE_INTERVAL'' seconds during the run, and written
+    to the file it names in collapsed format, as read by flame graph tools.
+    The file name is passed through ``strftime'', so each run may get its own."""
+    if not enabled():
+        yield
+        return
+    take()
+    samples = get_setting("ETL_PROFILE_SAMPLES")
+    sampler = None
+    if samples:
+        sampler = Sampler(float(get_setting("ETL_PROFILE_INTERVAL", "0.01")))
+        sampler.start()
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - started
+        if sampler:
+            sampler.stop()
+            path = datetime.now().strftime(samples)
+            sampler.write(path)
+            LOG.info("Wrote %d stack samples to %s", sum(sampler.stacks.values()), path)
+        report(name, elapsed)
+
+
+def record(name, seconds, count=1):
+    """Add seconds and count to the totals of the named stage."""
+    with STAGES_LOCK:
+        totals = STAGES.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += count
+
+
+def report(name, elapsed):
+    """Log the totals of every stage, slowest first."""
+    LOG.info("Profile of %s ETL run (%.1fs):", name, elapsed)
+    with STAGES_LOCK:
+        totals = sorted(STAGES.items(), key=lambda item: item[1][0], reverse=True)
+    for stage_name, (seconds, count) in totals:
+        LOG.info(
+            "%-12s %9.2fs %5.1f%% %10d× %10.1fµs",
+            stage_name,
+            seconds,
+            100 * seconds / (elapsed or 1),
+            count,
+            1e6 * seconds / (count or 1),
+        )
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as one pass through the named stage, if enabled."""
+    if not enabled():
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, perf_counter() - started)
+
+
+@contextmanager
+def stage_consuming(name, iterable):
+    """Time the enclosed block as the named stage, if enabled, and yield iterable.
+
+    Time spent producing the items of iterable is left out, as it belongs to
+    the stages upstream; each item consumed counts as a pass through the stage."""
+    if not enabled():
+        yield iterable
+        return
+    upstream = [0.0, 0]
+
+    def produce():
+        items = iter(iterable)
+        while True:
+            started = perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                upstream[0] += perf_counter() - started
+                return
+            upstream[0] += perf_counter() - started
+            upstream[1] += 1
+            yield item
+
+    started = perf_counter()
+    try:
+        yield produce()
+    finally:
+        record(name, perf_counter() - started - upstream[0], upstream[1])
+
+
+def take():
+    """Return the stage totals recorded so far, and start over from none."""
+    with STAGES_LOCK:
+        stages = dict(STAGES)
+        STAGES.clear()
+    return stages
+
+
+def timed(name, func):
+    """Return func, timing each call as a pass through the named stage if enabled."""
+    if not enabled():
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, perf_counter() - started)
+
+    return wrapper
@@ -0,0 +1,51 @@
+"""Reload vehicles from the artifacts of earlier ETL runs, without parsing any data dump.
+
+Pass the paths of the artifacts to replay; by default, the newest artifact of
+each country in ``ETL_ARTIFACT_DIR'' is replayed."""
+
+from glob import glob
+from os.path import join as path_join
+from sys import argv
+
+try:  # pragma: no cover
+    from etl_utils import ARTIFACT_SUFFIX, artifact_details, replay_artifact
+except (ImportError, ModuleNotFoundError):  # pragma: no cover
+    from plateypus.etl.etl_utils import (
+        ARTIFACT_SUFFIX,
+        artifact_details,
+        replay_artifact,
+    )
+finally:
+    from plateypus.helpers import get_setting, init_logger
+
+LOG = init_logger(__name__)
+
+
+def newest_artifacts(directory):
+    """Return the path of the newest artifact of each country in directory."""
+    newest = {}
+    for path in glob(path_join(directory, f"*{ARTIFACT_SUFFIX}")):
+        country, last_updated = artifact_details(path)
+        if country not in newest or last_updated > newest[country][1]:
+            newest[country] = path, last_updated
+    return sorted(path for path, _ in newest.values())
+
+
+def replay_all(paths=None):
+    """Replay the artifacts at paths, or the newest of each country if none are given."""
+    if not paths:
+        directory = get_setting("ETL_ARTIFACT_DIR")
+        if not directory:
+            LOG.error("No artifacts given, and ETL_ARTIFACT_DIR is not set.")
+            return False
+        paths = newest_artifacts(directory)
+    replayed = True
+    for path in paths:
+        if not replay_artifact(path):
+            LOG.error("Could not replay %s.", path)
+            replayed = False
+    return replayed
+
+
+if __name__ == "__main__":  # pragma: no cover
+    replay_all(argv[1:])
@@ -1,17 +1,105 @@
 """Little helpers."""
 
 
+from atexit import register
 from contextlib import contextmanager
 from datetime import datetime
+from hashlib import blake2b
+from json import dumps
 from logging import DEBUG, FileHandler, Formatter, StreamHandler, getLogger
 from os import environ
+from re import compile as re_compile
 from sys import stdout
+from threading import Lock, local
 
 from cerberus import Validator
+from cerberus.errors import ErrorList
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Q
 from pytz import utc
 
+CLIENTS = {}
+CLIENTS_LOCK = Lock()
+PLATE_MAX_GRAM = 10
+PLATE_MIN_INFIX_GRAM = 2
+PLATE_SEPARATORS = re_compile(r"[\s-]+")
+VALIDATORS = local()
+
+
+class SearchValidator(Validator):
+    """Validates search requests, checking well-formed ones without Cerberus.
+
+    Cerberus takes the better part of a millisecond to validate even a small
+    request. Requests that obviously conform to the schema are checked and
+    normalised in plain Python instead; all others are left to Cerberus, so
+    errors are reported exactly as before."""
+
+    def fast_validate(self, document):
+        """Return whether document obviously conforms to the search schema.
+
+        If so, the normalised document is set as if Cerberus had validated it."""
+        schema = self.schema
+        if not isinstance(document, dict) or not document.keys() <= schema.keys():
+            return False
+        size = document.get("size", schema["size"]["default"])
+        obvious = (
+            self.obvious_fields(document.get("fields"))
+            and self.obvious_size(size)
+            and (
+                "search_after" not in document
+                or self.obvious_cursor(document["search_after"])
+            )
+            and ("source" not in document or self.obvious_source(document["source"]))
+        )
+        if obvious:
+            self.document = dict(document, size=size)
+            self._errors = ErrorList()
+        return obvious
+
+    @staticmethod
+    def obvious_cursor(cursor):
+        """Return whether cursor is the score and content hash of a hit, as sorted on."""
+        if not isinstance(cursor, list) or len(cursor) != 2:
+            return False
+        score, content_hash = cursor
+        # Booleans are numbers, but not to Cerberus.
+        number = type(score) in (int, float)  # pylint: disable=unidiomatic-typecheck
+        return number and isinstance(content_hash, str)
+
+    def obvious_fields(self, fields):
+        """Return whether fields is a non-empty dict of allowed, non-empty strings."""
+        allowed = self.schema["fields"]["keysrules"]["allowed"]
+        return (
+            self.obvious_list(fields, dict)
+            and all(field in allowed for field in fields)
+            and all(isinstance(val, str) and val for val in fields.values())
+        )
+
+    @staticmethod
+    def obvious_list(items, kind=list):
+        """Return whether items is a non-empty instance of kind."""
+        return isinstance(items, kind) and bool(items)
+
+    def obvious_size(self, size):
+        """Return whether size is an integer within the allowed page sizes."""
+        rules = self.schema["size"]
+        # Booleans are integers, but not to Cerberus.
+        integer = type(size) is int  # pylint: disable=unidiomatic-typecheck
+        return integer and rules["min"] <= size <= rules["max"]
+
+    def obvious_source(self, source):
+        """Return whether source is a non-empty list of allowed field names."""
+        allowed = self.schema["source"]["schema"]["allowed"]
+        return self.obvious_list(source) and all(
+            isinstance(field, str) and field in allowed for field in source
+        )
+
+    def validate(self, document, *args, **kwargs):
+        """Validate document, taking the fast path if possible."""
+        if not args and not kwargs and self.fast_validate(document):
+            return True
+        return super().validate(document, *args, **kwargs)
+
 
 def app_settings():
     """Retrieve app settings from environment."""
@@ -23,25 +111,130 @@ def app_settings():
     )
 
 
+def build_plate_query(plate):
+    """Build an Elasticsearch query term for a normalised license plate (fragment).
+
+    Plates are matched against the ``plate_norm'' field of ``Vehicle'' and its
+    n-gram subfields, so that prefix (``AB1*''), suffix (``*345''), infix
+    (``*B12*'') and partial (``B12'') searches are all term lookups. Other
+    wildcard patterns, and fragments longer than the n-grams, fall back to a
+    wildcard query on ``plate_norm'', as do infixes shorter than the infix
+    n-grams."""
+    core = plate.strip("*")
+    if "*" in core or not 0 < len(core) <= PLATE_MAX_GRAM:
+        return Q("wildcard", plate_norm=plate)
+    if len(core) < PLATE_MIN_INFIX_GRAM:
+        infix = Q("wildcard", plate_norm=f"*{core}*")
+    else:
+        infix = Q("term", plate_norm__infix=core)
+    if plate.startswith("*") and plate.endswith("*"):
+        return infix
+    if plate.startswith("*"):
+        return Q("term", plate_norm__suffix=core[::-1])
+    if plate.endswith("*"):
+        return Q("term", plate_norm__prefix=core)
+    return Q(
+        "bool",
+        should=[
+            Q("term", plate_norm=dict(value=core, boost=3)),
+            Q("term", plate_norm__prefix=dict(value=core, boost=2)),
+            infix,
+        ],
+    )
+
+
 def build_query(field, fields, fuzziness="AUTO"):
-    """Build an Elasticsearch query term"""
+    """Build an Elasticsearch query term for a keyword field of ``Vehicle''.
+
+    Exact values are term lookups. Unless fuzziness is ``None'', the value
+    may also match the ``text'' subfield of field, tolerating typos. The
+    keywords are lower-cased when indexed, but wildcard patterns are not, so
+    they are lower-cased here."""
     val = fields[field]
     if "*" in val:
-        qtype = "wildcard"
-        fval = val
-    else:
-        qtype = "match"
-        fval = dict(query=val, fuzziness=fuzziness)
-    return Q(qtype, **{field: fval})
+        return Q("wildcard", **{field: val.lower()})
+    term = Q("term", **{field: val})
+    if fuzziness is None:
+        return term
+    return term | Q("match", **{f"{field}__text": dict(query=val, fuzziness=fuzziness)})
+
+
+def cache_key(prefix, *parts):
+    """Return a cache key for the given JSON-serializable parts."""
+    canonical = dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return f"{prefix}/{blake2b(canonical.encode(), digest_size=16).hexdigest()}"
+
+
+@register
+def close_elastic():
+    """Close the connection pools of all Elastic clients created by ``elastic''.
+
+    Registered to run when the interpreter exits."""
+    with CLIENTS_LOCK:
+        while CLIENTS:
+            CLIENTS.popitem()[1].close()
 
 
 @contextmanager
 def elastic():
-    """Return an initialized Elastic client."""
+    """Return an initialized Elastic client.
+
+    The client, and its pool of keep-alive connections, is created once per
+    process and shared by all callers; it is thread-safe. A new client is
+    only created if the connection settings change."""
+    url, options = elastic_options()
+    key = (url, *sorted(options.items()))
+    with CLIENTS_LOCK:
+        if key not in CLIENTS:
+            CLIENTS[key] = Elasticsearch(url, **options)
+        client = CLIENTS[key]
+    yield client
+
+
+def elastic_options():
+    """Return the URL of the Elastic server, and the options to create a client with.
+
+    Shared by synchronous and asynchronous clients."""
     host = get_setting("ELASTIC_HOST", "localhost")
     port = get_setting("ELASTIC_PORT", "9200")
     protocol = get_setting("ELASTIC_PROTOCOL", "http")
-    yield Elasticsearch(f"{protocol}://{host}:{port}")
+    sniffer_timeout = get_setting("ELASTIC_SNIFFER_TIMEOUT")
+    options = dict(
+        maxsize=int(get_setting("ELASTIC_MAXSIZE", "10")),
+        timeout=float(get_setting("ELASTIC_TIMEOUT", "10")),
+        max_retries=int(get_setting("ELASTIC_MAX_RETRIES", "3")),
+        retry_on_timeout=(
+            get_setting("ELASTIC_RETRY_ON_TIMEOUT", "False").capitalize() == "True"
+        ),
+        sniff_on_start=(
+            get_setting("ELASTIC_SNIFF_ON_START", "False").capitalize() == "True"
+        ),
+        sniff_on_connection_fail=(
+            get_setting("ELASTIC_SNIFF_ON_CONNECTION_FAIL", "False").capitalize()
+            == "True"
+        ),
+        sniffer_timeout=sniffer_timeout and float(sniffer_timeout),
+    )
+    return f"{protocol}://{host}:{port}", options
+
+
+def facets_validator():
+    """Return a facets request validator."""
+    max_size = int(get_setting("FACETS_MAX_SIZE", "100"))
+
+    def schema():
+        return dict(
+            country=dict(type="string", empty=False),
+            size=dict(
+                type="integer",
+                coerce=int,
+                default=min(10, max_size),
+                min=1,
+                max=max_size,
+            ),
+        )
+
+    return thread_validator(("facets", max_size), schema)
 
 
 def get_setting(key, default=None):
@@ -82,22 +275,126 @@ def init_logger(logger=None, lvl=None):
     return logger
 
 
+def normalise_fields(fields):
+    """Return a copy of search fields with surrounding whitespace stripped.
+
+    The plate is normalised with ``normalise_plate''."""
+    normalised = {field: val.strip() for field, val in fields.items()}
+    if "plate" in normalised:
+        normalised["plate"] = normalise_plate(normalised["plate"])
+    return normalised
+
+
+def normalise_plate(plate):
+    """Return plate in upper case, without whitespace or dashes."""
+    return PLATE_SEPARATORS.sub("", plate).upper()
+
+
+def search_batch_validator():
+    """Return a batch search request validator.
+
+    Only the list itself is validated; each of its fields should be validated
+    with the ``search_validator''."""
+    max_length = int(get_setting("SEARCH_BATCH_SIZE", "100"))
+
+    def schema():
+        return dict(
+            fields=dict(type="list", empty=False, maxlength=max_length, required=True)
+        )
+
+    return thread_validator(("search_batch", max_length), schema)
+
+
+def search_page(document):
+    """Return the page size, cursor and source fields of a validated search request."""
+    return {opt: document.get(opt) for opt in ("search_after", "size", "source")}
+
+
 def search_validator():
-    """Return a search request validator."""
-    schema = dict(
-        fields=dict(
-            type="dict",
-            keysrules=dict(
-                type="string", allowed=["country", "plate", "vin", "maker", "model"]
+    """Return a search request validator.
+
+    Besides the search ``fields'', a request may give the page ``size'', the
+    ``search_after'' cursor of the previous page and the ``source'' fields to
+    return for each hit."""
+    max_size = int(get_setting("SEARCH_MAX_SIZE", "100"))
+
+    def schema():
+        return dict(
+            fields=dict(
+                type="dict",
+                keysrules=dict(
+                    type="string", allowed=["country", "plate", "vin", "maker", "model"]
+                ),
+                valuesrules=dict(type="string", empty=False),
+                empty=False,
+                required=True,
+            ),
+            search_after=dict(
+                type="list", items=[dict(type="number"), dict(type="string")]
+            ),
+            size=dict(type="integer", default=min(10, max_size), min=1, max=max_size),
+            source=dict(
+                type="list",
+                empty=False,
+                schema=dict(
+                    type="string",
+                    allowed=[
+                        "colour",
+                        "country",
+                        "first_reg",
+                        "fuel_type",
+                        "maker",
+                        "model",
+                        "plate",
+                        "raw_xml",
+                        "vin",
+                    ],
+                ),
             ),
-            valuesrules=dict(type="string", empty=False),
-            empty=False,
-            required=True,
         )
-    )
-    return Validator(schema)
+
+    return thread_validator(("search", max_size), schema, SearchValidator)
+
+
+def suggest_validator():
+    """Return a plate suggestion request validator.
+
+    Plates are suggested per country, so a ``country'' is required along
+    with the ``prefix''."""
+    max_size = int(get_setting("SUGGEST_MAX_SIZE", "50"))
+
+    def schema():
+        return dict(
+            country=dict(type="string", empty=False, required=True),
+            prefix=dict(type="string", empty=False, required=True),
+            size=dict(
+                type="integer",
+                coerce=int,
+                default=min(10, max_size),
+                min=1,
+                max=max_size,
+            ),
+        )
+
+    return thread_validator(("suggest", max_size), schema)
 
 
 def t_0():
     """Return a timezone-aware ``datetime'' object representing the dawn of time."""
     return datetime.min.replace(tzinfo=utc)
+
+
+def thread_validator(key, schema, validator_class=Validator):
+    """Return a validator for the schema returned by ``schema()'', created once
+    per thread and key, and reused.
+
+    Creating a validator normalises its schema, which is slow, so the schema
+    is only built when there is no validator for key yet; key must tell apart
+    all the schemas it may return, e.g. by the settings they depend on.
+    Validators keep the last document they validated, so each thread gets
+    its own."""
+    validators = VALIDATORS.__dict__.setdefault("validators", {})
+    key = (validator_class, key)
+    if key not in validators:
+        validators[key] = validator_class(schema())
+    return validators[key]
@@ -1,15 +1,84 @@
 """ODM model definitions."""
 
-from elasticsearch_dsl import Date, Document, Keyword, Text
+from datetime import datetime
+from hashlib import blake2b
+from json import dumps
+
+from elasticsearch_dsl import (
+    Completion,
+    Date,
+    Document,
+    InnerDoc,
+    Keyword,
+    Long,
+    Object,
+    Text,
+    analyzer,
+    normalizer,
+    token_filter,
+)
 
 try:  # pragma: no cover
-    from helpers import elastic
+    from helpers import (
+        PLATE_MAX_GRAM,
+        PLATE_MIN_INFIX_GRAM,
+        build_plate_query,
+        build_query,
+        elastic,
+        normalise_plate,
+    )
 except (ImportError, ModuleNotFoundError):  # pragma: no cover
-    from plateypus.helpers import elastic
+    from plateypus.helpers import (
+        PLATE_MAX_GRAM,
+        PLATE_MIN_INFIX_GRAM,
+        build_plate_query,
+        build_query,
+        elastic,
+        normalise_plate,
+    )
 
 
+FACETS = ("colour", "fuel_type", "maker", "model")
 INDEX_METADATA = "plateypus-metadata"
 INDEX_VEHICLES = "plateypus-vehicles"
+INDEX_VEHICLES_DEFAULT = f"{INDEX_VEHICLES}-default"
+LOWERCASE = normalizer("lowercase_keyword", filter=["lowercase"])
+PLATE_EDGE_NGRAM = token_filter(
+    "plate_edge_ngram", "edge_ngram", min_gram=1, max_gram=PLATE_MAX_GRAM
+)
+PLATE_NGRAM = token_filter(
+    "plate_ngram", "ngram", min_gram=PLATE_MIN_INFIX_GRAM, max_gram=PLATE_MAX_GRAM
+)
+SOURCE_EXCLUDES = ["content_hash", "plate_norm", "plate_suggest", "raw_xml"]
+
+
+def plate_ngrams(name, *filters):
+    """Return a subfield indexing the given n-grams of a normalised plate."""
+    return Text(
+        analyzer=analyzer(name, tokenizer="keyword", filter=list(filters)),
+        search_analyzer="keyword",
+        index_options="docs",
+        norms=False,
+    )
+
+
+class Run(InnerDoc):
+    """Represents the ledger of the latest ETL run for a country.
+
+    ``owner'' identifies the run holding the ledger, if any, and ``heartbeat''
+    when it last showed signs of life. Offsets count the bytes of the dump
+    read, and the vehicles certainly indexed, at the last checkpoint."""
+
+    owner = Keyword()
+    heartbeat = Date()
+    started = Date()
+    dump = Keyword()
+    stage = Keyword()
+    index = Keyword()
+    byte_offset = Long()
+    record_offset = Long()
+    indexed = Long()
+    failed = Long()
 
 
 class Metadata(Document):
@@ -17,29 +86,220 @@ class Metadata(Document):
 
     country = Keyword(required=True)
     last_updated = Date()
+    run = Object(Run)
 
     class Index:  # pylint: disable=missing-docstring,too-few-public-methods
         name = INDEX_METADATA
 
 
 class Vehicle(Document):
-    """Represents a vehicle."""
+    """Represents a vehicle.
+
+    ``INDEX_VEHICLES`` is an alias spanning one versioned index per country,
+    plus a default index that receives vehicles saved outside of an ETL load.
+    Apart from the plate, vehicle details are case-insensitive keywords, so
+    they can be filtered on and aggregated; maker and model can also be
+    searched as full text through their ``text'' subfields. ``ident'' is the
+    id of the vehicle record in the register it was loaded from, if known."""
 
     country = Keyword(required=True)
     plate = Text(required=True)
-    first_reg = Text()
-    vin = Text()
-    maker = Text()
-    model = Text()
-    fuel_type = Text()
-    colour = Text()
-    raw_xml = Text()
+    plate_norm = Keyword(
+        fields=dict(
+            prefix=plate_ngrams("plate_prefix", PLATE_EDGE_NGRAM),
+            infix=plate_ngrams("plate_infix", PLATE_NGRAM),
+            suffix=plate_ngrams("plate_suffix", "reverse", PLATE_EDGE_NGRAM),
+        )
+    )
+    plate_suggest = Completion(
+        analyzer="keyword",
+        contexts=[dict(name="country", type="category", path="country")],
+    )
+    first_reg = Date()
+    vin = Keyword(normalizer=LOWERCASE)
+    maker = Keyword(normalizer=LOWERCASE, fields=dict(text=Text()))
+    model = Keyword(normalizer=LOWERCASE, fields=dict(text=Text()))
+    fuel_type = Keyword(normalizer=LOWERCASE)
+    colour = Keyword(normalizer=LOWERCASE)
+    raw_xml = Text(index=False)
+    content_hash = Keyword(index=False)
+    ident = Keyword()
 
     class Index:  # pylint: disable=missing-docstring,too-few-public-methods
         name = INDEX_VEHICLES
+        settings = dict(
+            codec="best_compression",
+            max_ngram_diff=PLATE_MAX_GRAM - PLATE_MIN_INFIX_GRAM,
+        )
+
+    def clean(self):
+        """Derive the normalised plate, its suggestion and the content hash.
+
+        The first registration is a calendar date, so any time is dropped."""
+        if isinstance(self.first_reg, datetime):
+            self.first_reg = self.first_reg.date()
+        self.plate_norm = normalise_plate(self.plate)
+        self.plate_suggest = self.plate_norm
+        self.content_hash = hash_source(self.to_dict())
+
+
+class VehicleRecord:  # pylint: disable=too-many-instance-attributes
+    """A vehicle on its way into Elasticsearch, built by the ETL routines.
+
+    ETL routines handle millions of vehicles, so unlike ``Vehicle'' a record
+    keeps its values in slots, without validation or conversion. ``clean''
+    and ``to_dict'' work like they do for a ``Vehicle'' with the same values,
+    so both make the same bulk actions."""
+
+    __slots__ = (
+        "country",
+        "plate",
+        "plate_norm",
+        "plate_suggest",
+        "first_reg",
+        "vin",
+        "maker",
+        "model",
+        "fuel_type",
+        "colour",
+        "raw_xml",
+        "content_hash",
+        "ident",
+    )
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        country,
+        plate,
+        plate_norm=None,
+        plate_suggest=None,
+        first_reg=None,
+        vin=None,
+        maker=None,
+        model=None,
+        fuel_type=None,
+        colour=None,
+        raw_xml=None,
+        content_hash=None,
+        ident=None,
+    ):
+        self.country = country
+        self.plate = plate
+        self.plate_norm = plate_norm
+        self.plate_suggest = plate_suggest
+        self.first_reg = first_reg
+        self.vin = vin
+        self.maker = maker
+        self.model = model
+        self.fuel_type = fuel_type
+        self.colour = colour
+        self.raw_xml = raw_xml
+        self.content_hash = content_hash
+        self.ident = ident
+
+    def __reduce__(self):
+        return VehicleRecord, tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"VehicleRecord({self.country!r}, {self.plate!r})"
+
+    def clean(self):
+        """Derive the normalised plate, its suggestion and the content hash.
+
+        See ``Vehicle.clean''."""
+        if isinstance(self.first_reg, datetime):
+            self.first_reg = self.first_reg.date()
+        self.plate_norm = self.plate_suggest = normalise_plate(self.plate)
+        self.content_hash = hash_source(self.to_dict())
+
+    def to_dict(self):
+        """Return the values of the record, leaving out those that are None."""
+        values = ((name, getattr(self, name)) for name in self.__slots__)
+        return {name: value for name, value in values if value is not None}
+
+
+def country_alias(country):
+    """Return the name of the alias pointing to the live vehicle index for country."""
+    return f"{INDEX_VEHICLES}-{country.lower()}"
+
+
+def hash_source(source):
+    """Return a hash of a vehicle source, not counting its current content hash."""
+    source = dict(source)
+    source.pop("content_hash", None)
+    return blake2b(
+        dumps(source, sort_keys=True, default=str).encode(), digest_size=16
+    ).hexdigest()
+
+
+def vehicle_facets(country=None, size=10, using=None):
+    """Return a ``Vehicle'' search counting vehicles per facet value.
+
+    Counts the size most common values of each of the ``FACETS'', and the
+    vehicles first registered each year, in a single query without hits."""
+    _search = Vehicle.search(using=using).extra(track_total_hits=True)[:0]
+    if country:
+        _search = _search.filter("term", country=country)
+    for facet in FACETS:
+        _search.aggs.bucket(facet, "terms", field=facet, size=size)
+    _search.aggs.bucket(
+        "first_reg",
+        "date_histogram",
+        field="first_reg",
+        interval="year",
+        format="yyyy",
+        min_doc_count=1,
+    )
+    return _search
+
+
+def vehicle_index(name):
+    """Return an index with the given name, and the settings and mapping of ``Vehicle''."""
+    return Vehicle._index.clone(name=name)  # pylint: disable=protected-access
+
+
+def vehicle_lookup(vehicle_id, using=None, raw_xml=False):
+    """Return a ``Vehicle'' search for the vehicle with the given id.
+
+    Vehicles live behind an alias spanning several indices, so they are
+    looked up by id rather than fetched with a GET. The fields derived by
+    ``Vehicle.clean'' are left out, and so is ``raw_xml'' unless requested."""
+    excludes = [field for field in SOURCE_EXCLUDES if not raw_xml or field != "raw_xml"]
+    _search = Vehicle.search(using=using).filter("ids", values=[vehicle_id])
+    return _search.source(excludes=excludes)[:1]
+
+
+def vehicle_search(fields, using=None, size=10, search_after=None, source=None):
+    """Return a ``Vehicle'' search for the given (normalised) search fields.
+
+    Hits are sorted by score, with ties broken by content hash, so the
+    ``sort'' values of the last hit of a page may be passed as search_after
+    to get the next page. Unless source lists the fields to return,
+    ``raw_xml'' and the fields derived by ``Vehicle.clean'' are left out.
+    Shared by the synchronous and asynchronous backends."""
+    _search = Vehicle.search(using=using).sort("_score", "content_hash")[:size]
+    if source:
+        _search = _search.source(source)
+    else:
+        _search = _search.source(excludes=SOURCE_EXCLUDES)
+    if search_after:
+        _search = _search.extra(search_after=search_after)
+    if "country" in fields:
+        _search = _search.filter("term", country=fields["country"])
+    if "plate" in fields:
+        _search = _search.query(build_plate_query(fields["plate"]))
+    for field in ("maker", "model"):
+        if field in fields:
+            _search = _search.query(build_query(field, fields))
+    if "vin" in fields:
+        _search = _search.query(build_query("vin", fields, fuzziness=None))
+    return _search
 
 
 if __name__ == "__main__":  # pragma: no cover
     with elastic() as client:
         Metadata.init(using=client)
-        Vehicle.init(using=client)
+        if not client.indices.exists_alias(name=INDEX_VEHICLES):
+            vehicle_index(INDEX_VEHICLES_DEFAULT).aliases(
+                **{INDEX_VEHICLES: dict(is_write_index=True)}
+            ).create(using=client)
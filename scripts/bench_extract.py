@@ -0,0 +1,44 @@
+"""Compare the per-record cost of extracting vehicle fields from the DMR test data."""
+
+from timeit import repeat
+from warnings import catch_warnings, simplefilter
+from zipfile import ZipFile
+
+from lxml import etree  # nosec <https://github.com/PyCQA/bandit/issues/435>
+
+from plateypus.etl.dk import NODE_NAMES
+from plateypus.etl.etl_utils import get_node_text, node_text_extractor
+
+TESTDATA = "tests/testdata/testdata_dk.zip"
+
+
+def statistik_elements(path):
+    """Return the ``Statistik'' elements of a zipped dump, and its namespace map."""
+    with ZipFile(path) as zipf, zipf.open(zipf.namelist()[0]) as xml:
+        root = etree.parse(xml).getroot()
+    nsmap = dict(ns=root.nsmap["ns"])
+    return root.findall(".//ns:Statistik", namespaces=nsmap), nsmap
+
+
+def per_record(func, elems, number=200):
+    """Return the best time in µs per element of calling func on every element."""
+    best = min(repeat(lambda: [func(elem) for elem in elems], number=number, repeat=5))
+    return best / number / len(elems) * 1e6
+
+
+if __name__ == "__main__":
+    ELEMS, NSMAP = statistik_elements(TESTDATA)
+    EXTRACT = node_text_extractor(NODE_NAMES, NSMAP)
+
+    with catch_warnings():
+        simplefilter("ignore")
+        BASELINE = per_record(
+            lambda elem: [get_node_text(elem, name, NSMAP) for name in NODE_NAMES],
+            ELEMS,
+        )
+        COMPILED = per_record(EXTRACT, ELEMS)
+
+    print(f"{len(ELEMS)} records, {len(NODE_NAMES)} fields each")
+    print(f"get_node_text:       {BASELINE:8.1f} µs/record")
+    print(f"node_text_extractor: {COMPILED:8.1f} µs/record")
+    print(f"speedup:             {BASELINE / COMPILED:8.1f}x")
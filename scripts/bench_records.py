@@ -0,0 +1,54 @@
+"""Compare building ETL vehicles as ``Vehicle'' documents and as ``VehicleRecord''s.
+
+For each kind, vehicles are built from the values in the DMR test data; the
+number of vehicles per second built and made into bulk actions is reported,
+along with the memory blocks and bytes allocated to keep each vehicle."""
+
+from gc import collect
+from itertools import cycle, islice
+from time import perf_counter
+from tracemalloc import start, stop, take_snapshot
+from warnings import catch_warnings, simplefilter
+
+from plateypus.etl.dk import Transform
+from plateypus.etl.etl_utils import vehicle_action
+from plateypus.models import Vehicle, VehicleRecord
+
+TESTDATA = "tests/testdata/testdata_dk.zip"
+
+
+def allocated(kind, fields, number=20000):
+    """Return the memory blocks and bytes allocated per vehicle kept."""
+    collect()
+    start()
+    before = take_snapshot()
+    kept = [kind(**values) for values in islice(cycle(fields), number)]
+    stats = take_snapshot().compare_to(before, "filename")
+    stop()
+    del kept
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    return blocks / number, size / number
+
+
+def per_second(kind, fields, number=20000):
+    """Return the best number of vehicles per second built and made into actions."""
+    best = float("inf")
+    for _ in range(5):
+        started = perf_counter()
+        for values in islice(cycle(fields), number):
+            vehicle_action("bench", kind(**values))
+        best = min(best, perf_counter() - started)
+    return number / best
+
+
+if __name__ == "__main__":
+    with catch_warnings():
+        simplefilter("ignore")
+        FIELDS = [record.to_dict() for record in Transform(TESTDATA).build_from_xml()]
+
+    print(f"{'':14}{'vehicles/s':>12}{'blocks':>10}{'bytes':>10}")
+    for KIND in (Vehicle, VehicleRecord):
+        RATE = per_second(KIND, FIELDS)
+        BLOCKS, SIZE = allocated(KIND, FIELDS)
+        print(f"{KIND.__name__:14}{RATE:12.0f}{BLOCKS:10.1f}{SIZE:10.0f}")
@@ -0,0 +1,160 @@
+"""Compare latency and throughput of the WSGI and ASGI backends under concurrent load.
+
+Both backends are started as separate server processes, querying a local
+stand-in for Elasticsearch which answers every request after a fixed delay."""
+
+from argparse import ArgumentParser
+from asyncio import gather, run
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from multiprocessing import Process
+from os import environ
+from socket import create_connection
+from statistics import quantiles
+from subprocess import DEVNULL, Popen  # nosec
+from sys import executable
+from time import perf_counter, sleep
+
+from aiohttp import ClientSession, TCPConnector
+
+SERVERS = dict(
+    wsgi=[executable, "-m", "waitress", "--threads={threads}", "--port={port}"]
+    + ["plateypus.backend:PLATEYPUS"],
+    asgi=[executable, "-m", "hypercorn", "--bind=127.0.0.1:{port}"]
+    + ["plateypus.asgi:PLATEYPUS"],
+)
+VEHICLE = dict(country="DK", plate="AB12345", maker="FORD", model="FIESTA")
+
+
+class FakeElastic(BaseHTTPRequestHandler):
+    """Answer Elasticsearch requests with a canned response after a fixed delay."""
+
+    delay = 0.02
+    disable_nagle_algorithm = True
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer info and search requests."""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/?") or self.path == "/":
+            self.reply(
+                dict(version=dict(number="7.17.0"), tagline="You Know, for Search")
+            )
+            return
+        sleep(self.delay)
+        hits = [] if "metadata" in self.path else [self.hit(n) for n in range(10)]
+        self.reply(dict(took=1, timed_out=False, hits=dict(hits=hits)))
+
+    do_POST = do_GET
+
+    @staticmethod
+    def hit(num):
+        """Return a search hit, with the sort values of a page of ``vehicle_search''."""
+        return dict(
+            _index="plateypus-vehicles-dk",
+            _id=str(num),
+            _source=VEHICLE,
+            sort=[1.0, f"{num:032x}"],
+        )
+
+    def reply(self, body):
+        """Send body as a JSON response."""
+        data = dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Do not log requests."""
+
+
+def serve_elastic(port, delay):
+    """Serve the Elasticsearch stand-in on the given local port."""
+    FakeElastic.delay = delay
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeElastic)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def wait_for(port, timeout=30):
+    """Wait until something listens on the given local port."""
+    deadline = perf_counter() + timeout
+    while True:
+        try:
+            create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            if perf_counter() > deadline:
+                raise
+            sleep(0.1)
+
+
+async def load(url, requests, concurrency):
+    """Post searches to url from concurrent clients, and return latencies and duration."""
+    latencies = []
+    payload = dict(fields=dict(country="DK", plate="AB1234"))
+
+    async def client(session, count):
+        for _ in range(count):
+            start = perf_counter()
+            async with session.post(url, json=payload) as resp:
+                await resp.read()
+                assert resp.status == 200, resp.status  # nosec
+            latencies.append(perf_counter() - start)
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        await client(session, concurrency)  # warm up
+        latencies.clear()
+        start = perf_counter()
+        await gather(
+            *(client(session, requests // concurrency) for _ in range(concurrency))
+        )
+        return latencies, perf_counter() - start
+
+
+def bench(kind, args):
+    """Run the load against one kind of backend, and return its statistics."""
+    env = dict(
+        environ, CACHE_TYPE="null", ELASTIC_PORT=str(args.es_port), LOG_LEVEL="40"
+    )
+    cmd = [part.format(port=args.port, threads=args.threads) for part in SERVERS[kind]]
+    with Popen(cmd, env=env, stdout=DEVNULL, stderr=DEVNULL) as server:  # nosec
+        try:
+            wait_for(args.port)
+            latencies, duration = run(
+                load(
+                    f"http://127.0.0.1:{args.port}/search",
+                    args.requests,
+                    args.concurrency,
+                )
+            )
+        finally:
+            server.terminate()
+    cuts = quantiles(latencies, n=100)
+    return cuts[49] * 1000, cuts[98] * 1000, len(latencies) / duration
+
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description=__doc__.splitlines()[0])
+    PARSER.add_argument("--concurrency", type=int, default=50)
+    PARSER.add_argument("--delay", type=float, default=0.02, help="ES latency in s")
+    PARSER.add_argument("--es-port", type=int, default=9299)
+    PARSER.add_argument("--port", type=int, default=5099)
+    PARSER.add_argument("--requests", type=int, default=2000)
+    PARSER.add_argument("--threads", type=int, default=8, help="WSGI threads")
+    ARGS = PARSER.parse_args()
+
+    ELASTIC = Process(target=serve_elastic, args=(ARGS.es_port, ARGS.delay))
+    ELASTIC.start()
+    try:
+        wait_for(ARGS.es_port)
+        print(f"{ARGS.requests} searches, {ARGS.concurrency} concurrent clients")
+        print(f"{'':6} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+        for KIND in SERVERS:
+            P50, P99, RPS = bench(KIND, ARGS)
+            print(f"{KIND:6} {P50:8.1f} {P99:8.1f} {RPS:8.1f}")
+    finally:
+        ELASTIC.terminate()
@@ -0,0 +1,36 @@
+"""Compare the per-request cost of validating search requests.
+
+``fresh'' creates a Cerberus validator for every request, ``reused'' keeps one
+per thread, and ``fast'' is the validator returned by ``search_validator''."""
+
+from timeit import repeat
+
+from cerberus import Validator
+
+from plateypus import helpers
+
+PAYLOADS = dict(
+    valid=dict(fields=dict(country="DK", plate="AB12*"), size=20),
+    invalid=dict(fields=dict(country="DK", colour="red", plate=""), size=0),
+)
+SCHEMA = dict(helpers.search_validator().schema)
+
+
+def per_request(get_validator, payload, number=2000):
+    """Return the best time in µs of getting a validator and validating payload."""
+    best = min(
+        repeat(lambda: get_validator().validate(payload), number=number, repeat=5)
+    )
+    return best / number * 1e6
+
+
+if __name__ == "__main__":
+    VALIDATORS = dict(
+        fresh=lambda: Validator(SCHEMA),
+        reused=lambda: helpers.thread_validator("bench", lambda: SCHEMA),
+        fast=helpers.search_validator,
+    )
+    print(f"{'':8}" + "".join(f"{name + ' µs':>12}" for name in VALIDATORS))
+    for NAME, PAYLOAD in PAYLOADS.items():
+        TIMES = [per_request(get, PAYLOAD) for get in VALIDATORS.values()]
+        print(f"{NAME:8}" + "".join(f"{time:12.1f}" for time in TIMES))
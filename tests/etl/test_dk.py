@@ -1,15 +1,22 @@
 """Test ETL routines for the Danish Motor Register."""
 
-from io import TextIOWrapper
+from datetime import datetime
+from io import BufferedReader, BytesIO
 from os import fdopen, remove
 from os.path import dirname, normpath, realpath
 from tempfile import mkstemp
+from types import GeneratorType
+from zipfile import ZipFile
 
-from pytest import mark
+from lxml import etree
+from pytest import mark, raises
 from pytest_mock import mocker
+from pytz import utc
 from shortuuid import uuid
 
+from plateypus.etl import dk, profiling
 from plateypus.etl.dk import Extract, Transform, extract_transform_load
+from plateypus.etl.etl_utils import FTPReader
 from plateypus.helpers import t_0
 
 PATH_TO_TESTDATA = normpath(f"{dirname(realpath(__file__))}/../testdata")
@@ -40,6 +47,33 @@ def test_no_new_data(mocker):
     assert actual == expected
 
 
+@mark.filterwarnings("ignore:Did not find")
+def test_streamed_dump_closed(mocker, monkeypatch):
+    """A dump streamed from FTP is closed along with its connection when the run ends."""
+    monkeypatch.delenv("ETL_ARTIFACT_DIR", raising=False)
+    with open(PATH_TO_TESTDATA + "/testdata_dk.zip", "rb") as dump:
+        data = dump.read()
+    host = mocker.MagicMock()
+    host.open.side_effect = lambda _path, _mode, rest=None: BytesIO(data[rest:])
+    connect = mocker.MagicMock(return_value=host)
+    remote = FTPReader(connect, "foo", len(data))
+    stream = BufferedReader(remote, 4096)
+    mocker.patch.object(Extract, "__init__", return_value=None)
+    mocker.patch.object(
+        Extract, "download_if_newer", return_value=(stream, datetime.now(utc))
+    )
+    ledger = mocker.MagicMock()
+    ledger.begin.return_value = 0
+    mocker.patch.object(dk, "run_ledger").return_value.__enter__.return_value = ledger
+    mocker.patch.object(
+        dk, "load_vehicles", side_effect=lambda _country, vehicles, *_: any(vehicles)
+    )
+    assert extract_transform_load()
+    assert stream.closed
+    assert remote.closed
+    assert host.close.call_count == connect.call_count
+
+
 @mark.filterwarnings("ignore:.*use_list_a_option.*:DeprecationWarning")
 def test_metadata_connection_error():
     """Test that no FTP host is created when trying to open an invalid URL."""
@@ -56,12 +90,112 @@ def test_metadata_connection_error():
 # region Transform
 
 
+@mark.filterwarnings("ignore:Did not find")
+def test_build_from_xml(monkeypatch):
+    """Vehicles are built from the dump, and their stages profiled if enabled."""
+    monkeypatch.setenv("ETL_PROFILE", "True")
+    profiling.STAGES.clear()
+    trf = Transform(PATH_TO_TESTDATA + "/testdata_dk.zip")
+    vehicles = list(trf.build_from_xml())
+    assert vehicles
+    assert all(vehicle.country == "dk" for vehicle in vehicles)
+    assert len({vehicle.ident for vehicle in vehicles}) == len(vehicles)
+    assert all(vehicle.raw_xml.startswith("<ns:Statistik") for vehicle in vehicles)
+    assert profiling.STAGES["extract"][1] == len(vehicles)
+    assert profiling.STAGES["serialize"][1] == len(vehicles)
+    assert {"decompress", "parse"} <= set(profiling.STAGES)
+    profiling.STAGES.clear()
+
+
+@mark.filterwarnings("ignore:Did not find")
+@mark.parametrize("ordered", ["True", "False"])
+def test_build_in_parallel(monkeypatch, ordered):
+    """Vehicles transformed by worker processes are the same as when transformed serially."""
+    trf = Transform(PATH_TO_TESTDATA + "/testdata_dk.zip")
+    serial = [vehicle.to_dict() for vehicle in trf.build_from_xml()]
+    monkeypatch.setenv("ETL_TRANSFORM_CHUNK_SIZE", "4096")
+    monkeypatch.setenv("ETL_TRANSFORM_ORDERED", ordered)
+    monkeypatch.setenv("ETL_TRANSFORM_WORKERS", "2")
+    parallel = [vehicle.to_dict() for vehicle in trf.build_from_xml()]
+    if ordered == "True":
+        assert parallel == serial
+    else:
+        assert sorted(map(repr, parallel)) == sorted(map(repr, serial))
+
+
+@mark.filterwarnings("ignore:Did not find")
+@mark.parametrize("workers", ["1", "2"])
+def test_build_from_xml_skips(monkeypatch, workers):
+    """Vehicles already loaded by an interrupted run are skipped, as are
+    whole chunks of them when transforming in parallel."""
+    trf = Transform(PATH_TO_TESTDATA + "/testdata_dk.zip")
+    serial = [vehicle.to_dict() for vehicle in trf.build_from_xml()]
+    monkeypatch.setenv("ETL_TRANSFORM_CHUNK_SIZE", "4096")
+    monkeypatch.setenv("ETL_TRANSFORM_WORKERS", workers)
+    for skip in (0, 5, len(serial)):
+        skipped = [vehicle.to_dict() for vehicle in trf.build_from_xml(skip)]
+        assert skipped == serial[skip:]
+    assert trf.offset == trf.size
+
+
+def test_statistik_chunks(monkeypatch):
+    """The dump is cut into well-formed documents between Statistik elements."""
+    monkeypatch.setenv("ETL_READ_CHUNK_SIZE", "1000")
+    trf = Transform(PATH_TO_TESTDATA + "/testdata_dk.zip")
+    chunks = list(trf.statistik_chunks(16384))
+    assert len(chunks) > 1
+    assert all(len(chunk) > 16384 for chunk in chunks[:-1])
+    roots = [etree.fromstring(chunk) for chunk in chunks]
+    namespaces = {"ns": "http://skat.dk/dmr/2007/05/31/"}
+    counts = [
+        len(root.findall("ns:StatistikSamling/ns:Statistik", namespaces))
+        for root in roots
+    ]
+    assert sum(counts) == 9
+    assert all(counts)
+
+
+def test_statistik_chunks_other_prefix():
+    """A dump binding its namespace to a prefix other than ``ns'' is refused."""
+    dump = BytesIO()
+    with ZipFile(dump, "w") as zipf:
+        zipf.writestr(
+            "dmr.xml",
+            '<?xml version="1.0"?>\n<x:Root xmlns:x="http://skat.dk/dmr/2007/05/31/">'
+            "<x:Statistik/></x:Root>",
+        )
+    trf = Transform(dump)
+    with raises(ValueError):
+        list(trf.statistik_chunks(16384))
+
+
+def test_xml_pull_events_lazy():
+    """XML parser events are yielded as they are parsed, not collected up front."""
+    trf = Transform(PATH_TO_TESTDATA + "/testdata_dk.zip")
+    events = trf.xml_pull_events()
+    assert isinstance(events, GeneratorType)
+    event, (prefix, uri) = next(events)
+    assert event == "start-ns"
+    assert prefix == "ns"
+    assert uri == "http://skat.dk/dmr/2007/05/31/"
+    events.close()
+
+
 def test_xml_stream():
-    """A ``TextIOWrapper'' is returned if a zipfile is provided."""
+    """A binary stream of the unzipped dump is returned if a zipfile is provided."""
     trf = Transform(PATH_TO_TESTDATA + "/testdata_dk.zip")
-    xml_stream = trf.xml_stream()
-    assert isinstance(xml_stream, TextIOWrapper)
-    assert xml_stream.encoding == "utf-8"
+    with trf.xml_stream() as xml_stream:
+        assert xml_stream.read(5) == b"<?xml"
+    assert trf.size == 65561
+
+
+def test_xml_stream_from_file_object():
+    """A binary stream of the unzipped dump is returned if a zipped file object
+    is provided, as when streaming straight from the DMR FTP server."""
+    with open(PATH_TO_TESTDATA + "/testdata_dk.zip", "rb") as dump:
+        trf = Transform(BytesIO(dump.read()))
+    with trf.xml_stream() as xml_stream:
+        assert xml_stream.read(5) == b"<?xml"
 
 
 def test_xml_stream_multi_zipfile():
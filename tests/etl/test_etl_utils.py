@@ -1,21 +1,76 @@
 """Test ETL utility methods."""
 
-from collections import namedtuple
-from datetime import datetime
-from io import StringIO
+from collections import Counter, namedtuple
+from datetime import date, datetime
+from glob import glob
+from gzip import open as gzip_open
+from io import BufferedReader, BytesIO, StringIO
+from json import loads
+from os import remove
+from os.path import dirname, normpath, realpath
+from pathlib import Path
+from pickle import dumps as pickle, loads as unpickle  # nosec
+from random import randint
+from secrets import token_bytes
+from tempfile import gettempdir
 from time import sleep
 from types import SimpleNamespace as obj
 from warnings import warn
+from zipfile import ZipFile
 
-from ftputil.error import TemporaryError
+from ftputil.error import FTPOSError, TemporaryError
 from lxml import etree
-from pytest import fixture, mark, warns
+from pytest import fixture, mark, raises, warns
 from pytz import utc
 from shortuuid import uuid
 
 from plateypus.etl import etl_utils
 from plateypus.helpers import elastic, t_0
-from plateypus.models import Metadata, Vehicle
+from plateypus.models import Metadata, Vehicle, VehicleRecord, country_alias
+
+PATH_TO_TESTDATA = normpath(
+    f"{dirname(realpath(__file__))}/../testdata/testdata_dk.zip"
+)
+
+
+class FakeFTPHost:
+    """Local stand-in for an ``FTPHost'' serving one file from memory.
+
+    Every connection drops once ``drop_after'' bytes have been read from it,
+    if given. Offsets of all transfers are recorded in ``rests''."""
+
+    def __init__(self, data, drop_after=None, rests=None):
+        self.data = data
+        self.drop_after = drop_after
+        self.rests = [] if rests is None else rests
+
+    def close(self):
+        """Close the connection."""
+
+    def open(self, _path, _mode, rest=None):
+        """Open the file for reading, starting at offset ``rest''."""
+        self.rests.append(rest)
+        remote = BytesIO(self.data[rest or 0 :])
+        if self.drop_after is not None:
+            read = remote.read
+
+            def flaky_read(size=-1):
+                if remote.tell() >= self.drop_after:
+                    raise FTPOSError("Connection dropped")
+                return read(min(size, self.drop_after - remote.tell()))
+
+            remote.read = flaky_read
+        return remote
+
+
+@fixture
+def ftp_file():
+    """Yield random file contents, and a local target path to download them to."""
+    data = token_bytes(randint(10000, 20000))
+    target = f"{gettempdir()}/{uuid()}"
+    yield data, target
+    for path in glob(f"{target}*"):
+        remove(path)
 
 
 @fixture
@@ -24,7 +79,7 @@ def seven_vehicles():
     country = uuid()
     vehicles = []
     for _ in range(0, 7):
-        vehicles.append(Vehicle(country=country, plate=uuid()))
+        vehicles.append(Vehicle(country=country, plate=uuid(), ident=uuid()))
     CountryVehicles = namedtuple("CountryVehicles", ["country", "vehicles"])
     return CountryVehicles(country, vehicles)
 
@@ -51,6 +106,105 @@ def xml():
     yield dict(events=events, nsmap=nsmap)
 
 
+def test_artifact_path(monkeypatch, tmp_path):
+    """Test that artifact paths are only given if enabled, and carry country and time."""
+    last_updated = datetime(2020, 12, 24, 18, 30, tzinfo=utc)
+    monkeypatch.delenv("ETL_ARTIFACT_DIR", raising=False)
+    assert etl_utils.artifact_path("xx", last_updated) is None
+    monkeypatch.setenv("ETL_ARTIFACT_DIR", str(tmp_path))
+    path = etl_utils.artifact_path("xx", last_updated)
+    assert path.startswith(str(tmp_path))
+    assert etl_utils.artifact_details(path) == ("xx", last_updated)
+
+
+@mark.parametrize("workers", ["1", "3"])
+def test_bulk_load_checkpoints(mocker, monkeypatch, workers):
+    """Test that checkpoints never count actions that may not have been processed."""
+    monkeypatch.setenv("ETL_BULK_CHUNK_SIZE", "10")
+    monkeypatch.setenv("ETL_BULK_WORKERS", workers)
+    monkeypatch.setenv("ETL_CHECKPOINT_INTERVAL", "100")
+    processed = []
+    checkpoints = []
+
+    def fake_bulk(_client, chunk, **_kwargs):
+        for action in chunk:
+            processed.append(action)
+            yield True, dict(index=action)
+
+    def checkpoint(records):
+        assert set(range(records)) <= set(processed)
+        checkpoints.append(records)
+
+    mocker.patch.object(etl_utils, "streaming_bulk", fake_bulk)
+    assert etl_utils.bulk_load(None, iter(range(1000)), checkpoint) == (1000, 0)
+    assert len(checkpoints) == 10
+    assert checkpoints == sorted(checkpoints)
+    if workers == "1":
+        assert checkpoints == list(range(100, 1001, 100))
+
+
+def test_bulk_load_checkpoints_slow_chunk(mocker, monkeypatch):
+    """Test that checkpoints wait for a slow first chunk, though later chunks
+    complete before it."""
+    monkeypatch.setenv("ETL_BULK_CHUNK_SIZE", "10")
+    monkeypatch.setenv("ETL_BULK_WORKERS", "3")
+    monkeypatch.setenv("ETL_CHECKPOINT_INTERVAL", "10")
+    processed = []
+    checkpoints = []
+
+    def fake_bulk(_client, chunk, **_kwargs):
+        if chunk[0] == 0:
+            sleep(0.5)
+        for action in chunk:
+            processed.append(action)
+            yield True, dict(index=action)
+
+    def checkpoint(records):
+        assert set(range(records)) <= set(processed)
+        checkpoints.append(records)
+
+    mocker.patch.object(etl_utils, "streaming_bulk", fake_bulk)
+    assert etl_utils.bulk_load(None, iter(range(200)), checkpoint) == (200, 0)
+    assert processed[:10] != list(range(10))
+    assert checkpoints == sorted(checkpoints)
+    assert checkpoints[-1] == 200
+
+
+def test_bulk_load_parallel(mocker):
+    """Test that all actions are sent, and no more than the allowed number of
+    chunks are taken from the producer ahead of completed requests."""
+    consumed = []
+    in_flight = []
+    sent = []
+
+    def actions():
+        for action in range(1000):
+            consumed.append(action)
+            in_flight.append(len(consumed) - len(sent))
+            yield action
+
+    def fake_bulk(_client, chunk, **_kwargs):
+        for action in chunk:
+            sent.append(action)
+            yield True, dict(index=action)
+
+    mocker.patch.object(etl_utils, "streaming_bulk", fake_bulk)
+    results = list(etl_utils.bulk_load_parallel(None, actions(), 3, 2, chunk_size=10))
+    assert len(results) == 1000
+    assert sorted(sent) == list(range(1000))
+    assert max(in_flight) <= (3 + 2 + 1) * 10
+
+
+def test_bulk_options(monkeypatch):
+    """Test that bulk options are read from env settings, with sane defaults."""
+    monkeypatch.delenv("ETL_BULK_MAX_BYTES", raising=False)
+    monkeypatch.setenv("ETL_BULK_CHUNK_SIZE", "1234")
+    options = etl_utils.bulk_options()
+    assert options["chunk_size"] == 1234
+    assert options["max_chunk_bytes"] == 10485760
+    assert options["max_retries"] > 0
+
+
 def test_clean_vehicles():
     """Verify that ``clean_vehicles'' deletes all vehicles from the given country."""
     country = uuid()
@@ -63,6 +217,14 @@ def test_clean_vehicles():
         assert Vehicle.search(using=client).filter("term", country=country).count() == 0
 
 
+def test_closing_tags():
+    """The end tags returned close the elements left open by a header, innermost first."""
+    header = b'<?xml version="1.0"?>\n<ns:a xmlns:ns="urn:x"><b><ns:c/><ns:d>'
+    footer = etl_utils.closing_tags(header)
+    assert footer == b"</ns:d></b></ns:a>"
+    assert etree.fromstring(header + b"<e/>" + footer) is not None
+
+
 @mark.filterwarnings("ignore:.*use_list_a_option.*:DeprecationWarning")
 def test_ftp_connect():
     """Test connection to FTP host."""
@@ -91,6 +253,88 @@ def test_ftp_noconnect():
     assert ftp is None
 
 
+def test_ftp_download(ftp_file):
+    """Test that a file is downloaded whole, and no part files are left behind."""
+    data, target = ftp_file
+    etl_utils.ftp_download(lambda: FakeFTPHost(data), "foo", target, len(data))
+    with open(target, "rb") as downloaded:
+        assert downloaded.read() == data
+    assert glob(f"{target}*") == [target]
+
+
+def test_ftp_download_resumes(ftp_file, monkeypatch):
+    """Test that dropped connections are resumed where they left off."""
+    monkeypatch.setattr(etl_utils, "sleep", lambda _: None)
+    data, target = ftp_file
+    rests = []
+    etl_utils.ftp_download(
+        lambda: FakeFTPHost(data, 4000, rests), "foo", target, len(data)
+    )
+    with open(target, "rb") as downloaded:
+        assert downloaded.read() == data
+    assert rests[:3] == [0, 4000, 8000]
+
+
+def test_ftp_download_resumes_part_file(ftp_file):
+    """Test that a part file left by an earlier attempt is resumed."""
+    data, target = ftp_file
+    with open(f"{target}.1.part0", "wb") as part:
+        part.write(data[:1234])
+    rests = []
+    etl_utils.ftp_download(
+        lambda: FakeFTPHost(data, rests=rests), "foo", target, len(data)
+    )
+    assert rests == [1234]
+    with open(target, "rb") as downloaded:
+        assert downloaded.read() == data
+
+
+def test_ftp_download_segmented(ftp_file):
+    """Test that a file downloaded in parallel segments is put together correctly."""
+    data, target = ftp_file
+    rests = []
+    etl_utils.ftp_download(
+        lambda: FakeFTPHost(data, rests=rests), "foo", target, len(data), segments=4
+    )
+    with open(target, "rb") as downloaded:
+        assert downloaded.read() == data
+    assert sorted(rests) == [len(data) * num // 4 for num in range(4)]
+
+
+def test_ftp_download_gives_up(ftp_file, monkeypatch):
+    """Test that an incomplete download raises, keeping the part file for later."""
+    monkeypatch.setattr(etl_utils, "sleep", lambda _: None)
+    monkeypatch.setenv("ETL_FTP_RETRIES", "1")
+    data, target = ftp_file
+    with raises(OSError, match="Incomplete download"):
+        etl_utils.ftp_download(
+            lambda: FakeFTPHost(data, drop_after=100), "foo", target, len(data)
+        )
+    assert not Path(target).exists()
+    assert Path(f"{target}.1.part0").stat().st_size == 200
+
+
+def test_ftp_reader(monkeypatch):
+    """Test that a zipped dump can be read straight off an FTP server,
+    in a handful of transfers, even when connections drop."""
+    monkeypatch.setattr(etl_utils, "sleep", lambda _: None)
+    with open(PATH_TO_TESTDATA, "rb") as local:
+        data = local.read()
+    with ZipFile(PATH_TO_TESTDATA) as zipf:
+        expected = zipf.read(zipf.namelist()[0])
+    rests = []
+    remote = etl_utils.FTPReader(
+        lambda: FakeFTPHost(data, 1000, rests), "foo", len(data)
+    )
+    with BufferedReader(remote, 4096) as stream, ZipFile(stream) as zipf:
+        assert zipf.read(zipf.namelist()[0]) == expected
+    # A few seeks near the end to find the central directory, then one
+    # sequential read of the member, resumed every time a connection drops.
+    assert rests[-5:] == [0, 1000, 2000, 3000, 4000]
+    assert len(rests) < 10
+    assert remote.closed
+
+
 def test_get_node_text_found(xml):
     """Test that text can be retrieved from a node inside a node."""
     expected = "foo"
@@ -165,7 +409,26 @@ def test_load_vehicles(seven_vehicles):
         assert search.count() == 7
 
         # Teardown
-        search.delete()
+        client.indices.delete(index=f"{country_alias(seven_vehicles.country)}-*")
+
+
+def test_load_vehicles_swaps_index(seven_vehicles):
+    """Test that reloading a country replaces its vehicles and drops the old index."""
+    country = seven_vehicles.country
+    etl_utils.load_vehicles(country, seven_vehicles.vehicles, datetime.now(utc))
+    reloaded = [Vehicle(country=country, plate=uuid()) for _ in range(3)]
+    etl_utils.load_vehicles(country, reloaded, datetime.now(utc))
+    sleep(2)
+
+    with elastic() as client:
+        search = Vehicle.search(using=client).filter("term", country=country)
+        assert search.count() == 3
+        sizes = etl_utils.index_sizes(client, f"{country_alias(country)}-*")
+        assert len(sizes) == 1
+        assert all(size > 0 for size in sizes.values())
+
+        # Teardown
+        client.indices.delete(index=f"{country_alias(country)}-*")
 
 
 def test_ls_lt():
@@ -183,6 +446,32 @@ def test_ls_lt():
     assert actual == expected
 
 
+def test_migrate_vehicles(seven_vehicles):
+    """Test that migrating a country reloads its vehicles into a new index."""
+    country = seven_vehicles.country
+    etl_utils.load_vehicles(country, seven_vehicles.vehicles, datetime.now(utc))
+    with elastic() as client:
+        before = list(client.indices.get_alias(name=country_alias(country)))
+        assert etl_utils.migrate_vehicles(country)
+        sleep(2)
+        after = list(client.indices.get_alias(name=country_alias(country)))
+        assert before != after
+        search = Vehicle.search(using=client).filter("term", country=country)
+        assert search.count() == 7
+
+        # Teardown
+        client.indices.delete(index=f"{country_alias(country)}-*")
+
+
+def test_migrate_vehicles_held(mocker):
+    """Test that nothing is migrated while another run holds the ledger."""
+    run_ledger = mocker.patch.object(etl_utils, "run_ledger")
+    run_ledger.return_value.__enter__.return_value = None
+    load = mocker.patch.object(etl_utils, "load_fresh_index")
+    assert not etl_utils.migrate_vehicles(uuid())
+    load.assert_not_called()
+
+
 def test_newer_than_latest():
     """Test whether the timestamp is newer than the one in the database."""
     country = uuid()
@@ -206,6 +495,110 @@ def test_newer_than_latest_first_run():
     assert not etl_utils.newer_than_latest(country, t_0())
 
 
+def test_node_text_extractor(xml):
+    """Test that all wanted nodes are extracted in one go, with the same results
+    and warnings as ``get_node_text''."""
+    names = ("textnode", "notextnode", "emptynode", "twinnode", "notfoundnode")
+    extract = etl_utils.node_text_extractor(names, xml["nsmap"])
+    uri = xml["nsmap"]["ns"]
+    for _, elem in xml["events"]:
+        if elem.tag == f"{{{uri}}}root":
+            with warns(UserWarning) as record:
+                actual = extract(elem)
+    assert actual == dict(
+        textnode="foo", notextnode="", emptynode="", twinnode="first", notfoundnode=""
+    )
+    messages = [str(warning.message) for warning in record]
+    assert "Did not find notfoundnode" in messages
+    assert "Found 2 twinnode nodes, only returning text of the first." in messages
+
+
+def test_parse_date():
+    """Test that dates are parsed regardless of any time or offset following them."""
+    assert etl_utils.parse_date("2010-08-16+02:00") == date(2010, 8, 16)
+    assert etl_utils.parse_date("1982-07-21T00:00:00") == date(1982, 7, 21)
+    assert etl_utils.parse_date(" \n ") is None
+    assert etl_utils.parse_date(None) is None
+    with warns(UserWarning):
+        assert etl_utils.parse_date("yesterday") is None
+
+
+def test_replay_artifact(seven_vehicles, tmp_path):
+    """Test that replaying an artifact loads its vehicles into a fresh index."""
+    country = seven_vehicles.country
+    path = str(tmp_path / f"{country}-20201224T183000+0000.ndjson.gz")
+    actions = (etl_utils.vehicle_action("foo", v) for v in seven_vehicles.vehicles)
+    assert len(list(etl_utils.write_artifact(path, actions))) == 7
+    assert etl_utils.replay_artifact(path)
+    sleep(2)
+
+    with elastic() as client:
+        search = Vehicle.search(using=client).filter("term", country=country)
+        assert search.count() == 7
+
+        # Teardown
+        client.indices.delete(index=f"{country_alias(country)}-*")
+        Metadata.search(using=client).filter("term", country=country).delete()
+
+
+def test_replay_artifact_held(mocker):
+    """Test that nothing is replayed while another run holds the ledger."""
+    run_ledger = mocker.patch.object(etl_utils, "run_ledger")
+    run_ledger.return_value.__enter__.return_value = None
+    load = mocker.patch.object(etl_utils, "load_fresh_index")
+    assert not etl_utils.replay_artifact("xx-20201224T183000+0000.ndjson.gz")
+    load.assert_not_called()
+
+
+def test_run_ledger(monkeypatch):
+    """Test that only one run holds the ledger, and that a run of the same dump
+    resumes from the last checkpoint of an interrupted one."""
+    country = uuid()
+    index = f"{country_alias(country)}-{uuid().lower()}"
+    with elastic() as client:
+        client.indices.create(index=index)
+    with raises(KeyboardInterrupt):
+        with etl_utils.run_ledger(country) as ledger:
+            with etl_utils.run_ledger(country) as rival:
+                assert rival is None
+            assert ledger.begin("dump-1") == 0
+            ledger.update(stage="load", index=index)
+            ledger.checkpoint(300)
+            raise KeyboardInterrupt
+    with etl_utils.run_ledger(country) as ledger:
+        assert ledger.previous["stage"] == "interrupted"
+        assert ledger.unfinished_index() == index
+        assert ledger.begin("dump-1") == 300
+        assert ledger.run["index"] == index
+        ledger.checkpoint(200)
+        assert ledger.run["record_offset"] == 500
+    with raises(KeyboardInterrupt):
+        with etl_utils.run_ledger(country) as ledger:
+            assert ledger.previous["stage"] == "done"
+            assert ledger.previous.get("owner") is None
+            assert ledger.unfinished_index() is None
+            assert ledger.begin("dump-1") == 0
+            ledger.update(stage="load", index=index)
+            raise KeyboardInterrupt
+    with etl_utils.run_ledger(country) as ledger:
+        assert ledger.begin("dump-2") == 0
+        with elastic() as client:
+            assert not client.indices.exists(index=index)
+
+    # A run that died without releasing the ledger is taken over once stale
+    monkeypatch.setenv("ETL_LOCK_TIMEOUT", "0")
+    held = etl_utils.RunLedger(country)
+    assert held.acquire()
+    held.released.set()
+    with etl_utils.run_ledger(country) as ledger:
+        assert ledger is not None
+        assert ledger.previous["owner"] == held.owner
+
+    # Teardown
+    with elastic() as client:
+        Metadata.search(using=client).filter("term", country=country).delete()
+
+
 def test_upsert_metadata():
     """Test that upsert_metadata inserts or updates data."""
     country = uuid()
@@ -249,3 +642,119 @@ def test_upsert_metadata():
         Metadata.search(using=client).filter("term", country=country).execute()[
             0
         ].delete(using=client)
+
+
+def test_vehicle_action():
+    """Test that bulk actions carry an id and hash that only depend on the vehicle."""
+    country, ident = uuid(), uuid()
+    first = etl_utils.vehicle_action(
+        "foo", Vehicle(country=country, plate="A", ident=ident)
+    )
+    again = etl_utils.vehicle_action(
+        "bar", Vehicle(country=country, plate="A", ident=ident)
+    )
+    moved = etl_utils.vehicle_action(
+        "foo", Vehicle(country=country, plate="b-1", ident=ident)
+    )
+    assert first["_index"] == "foo"
+    assert moved["_source"]["plate_norm"] == "B1"
+    assert first["_id"] == again["_id"] == moved["_id"]
+    assert first["_source"]["content_hash"] == again["_source"]["content_hash"]
+    assert first["_source"]["content_hash"] != moved["_source"]["content_hash"]
+
+
+def test_vehicle_action_ids():
+    """Test that vehicles sharing a VIN, or lacking both VIN and plate, keep
+    distinct ids, and that vehicles without an ident get none."""
+    vin = uuid()
+    vehicles = [
+        VehicleRecord(country="xx", plate="A", vin=vin, ident="1"),
+        VehicleRecord(country="xx", plate="B", vin=vin, ident="2"),
+        VehicleRecord(country="xx", plate="", vin="", ident="3"),
+        VehicleRecord(country="xx", plate="", vin="", ident="4"),
+    ]
+    actions = [etl_utils.vehicle_action("foo", vehicle) for vehicle in vehicles]
+    assert len({action["_id"] for action in actions}) == 4
+    anonymous = etl_utils.vehicle_action("foo", VehicleRecord(country="xx", plate=""))
+    assert "_id" not in anonymous
+    counts = Counter()
+    deltas = etl_utils.vehicle_deltas("foo", vehicles + vehicles[:1], {}, counts)
+    assert len(list(deltas)) == 5
+    assert counts == Counter(created=5)
+
+
+def test_vehicle_action_record():
+    """Test that a vehicle record makes the same bulk action as a Vehicle document."""
+    values = dict(
+        country=uuid(),
+        plate="ab 12",
+        first_reg=datetime(2004, 6, 3, 12),
+        vin=uuid(),
+        maker="AUDI",
+        model="A4 ",
+        colour="",
+        raw_xml="<ns:Statistik/>",
+    )
+    record = etl_utils.vehicle_action("foo", VehicleRecord(**values))
+    document = etl_utils.vehicle_action("foo", Vehicle(**values))
+    assert record == document
+    assert record["_source"]["first_reg"] == date(2004, 6, 3)
+    assert "fuel_type" not in record["_source"]
+    unpickled = unpickle(pickle(VehicleRecord(**values)))
+    assert unpickled.to_dict() == VehicleRecord(**values).to_dict()
+
+
+def test_vehicle_deltas(seven_vehicles):
+    """Test that only created, changed and removed vehicles result in bulk actions."""
+    vehicles = seven_vehicles.vehicles
+    known = {}
+    for vehicle in vehicles[:5]:
+        action = etl_utils.vehicle_action("foo", vehicle)
+        known[action["_id"]] = action["_source"]["content_hash"]
+    known[next(iter(known))] = "stale"
+    known["gone"] = "whatever"
+    counts = Counter()
+    actions = list(etl_utils.vehicle_deltas("foo", vehicles, known, counts))
+    assert counts == Counter(created=2, updated=1, deleted=1, unchanged=4)
+    assert len(actions) == 4
+    assert actions[-1] == dict(_op_type="delete", _index="foo", _id="gone")
+
+
+def test_write_artifact(tmp_path):
+    """Test that an artifact holds the actions passing through, in bulk API format."""
+    path = str(tmp_path / "xx-20201224T183000+0000.ndjson.gz")
+    vehicles = [
+        VehicleRecord(
+            country="xx", plate=uuid(), first_reg=date(2004, 6, 3), ident=uuid()
+        )
+        for _ in range(3)
+    ]
+    vehicles.append(VehicleRecord(country="xx", plate=uuid()))
+    actions = [etl_utils.vehicle_action("foo", vehicle) for vehicle in vehicles]
+    assert list(etl_utils.write_artifact(path, iter(actions))) == actions
+    assert not Path(f"{path}.part").exists()
+    with gzip_open(path, "rt") as artifact:
+        lines = artifact.read().splitlines()
+    assert loads(lines[0]) == dict(index=dict(_id=actions[0]["_id"]))
+    replayed = list(etl_utils.read_artifact("bar", path))
+    assert [action.get("_id") for action in replayed] == [
+        action.get("_id") for action in actions
+    ]
+    assert "_id" not in replayed[-1]
+    assert all(action["_index"] == "bar" for action in replayed)
+    assert loads(replayed[0]["_source"]) == dict(
+        actions[0]["_source"], first_reg="2004-06-03"
+    )
+
+
+def test_write_artifact_fails(tmp_path):
+    """Test that no artifact is left behind if the actions fail."""
+    path = str(tmp_path / "xx-20201224T183000+0000.ndjson.gz")
+
+    def actions():
+        yield etl_utils.vehicle_action("foo", VehicleRecord(country="xx", plate="A"))
+        raise ValueError("Transform failed")
+
+    with raises(ValueError):
+        list(etl_utils.write_artifact(path, actions()))
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,76 @@
+"""Test profiling of ETL stages."""
+
+from time import sleep
+
+from pytest import fixture
+
+from plateypus.etl import profiling
+
+
+@fixture
+def enabled(monkeypatch):
+    """Switch profiling on, starting from no recorded stages."""
+    monkeypatch.setenv("ETL_PROFILE", "true")
+    profiling.STAGES.clear()
+    yield profiling.STAGES
+    profiling.STAGES.clear()
+
+
+def test_disabled_is_free(monkeypatch):
+    """While profiling is off, functions and iterables are returned unwrapped."""
+    monkeypatch.delenv("ETL_PROFILE", raising=False)
+    items = [1, 2, 3]
+    assert profiling.timed("extract", len) is len
+    with profiling.stage_consuming("index", items) as consumed:
+        assert consumed is items
+    with profiling.stage("download"):
+        pass
+    assert "download" not in profiling.STAGES
+
+
+def test_profiled_run_samples(enabled, monkeypatch, tmp_path):
+    """Stack samples of the run are written in collapsed format."""
+    monkeypatch.setenv("ETL_PROFILE_INTERVAL", "0.001")
+    monkeypatch.setenv("ETL_PROFILE_SAMPLES", str(tmp_path / "run-%Y.folded"))
+    with profiling.profiled_run("xx"):
+        with profiling.stage("download"):
+            sleep(0.05)
+    (samples,) = tmp_path.iterdir()
+    lines = samples.read_text(encoding="utf-8").splitlines()
+    assert lines
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("test_profiled_run_samples" in line for line in lines)
+    assert enabled["download"][1] == 1
+
+
+def test_stage(enabled):
+    """Time spent in a stage is added up across passes."""
+    for _ in range(2):
+        with profiling.stage("download"):
+            sleep(0.01)
+    seconds, count = enabled["download"]
+    assert seconds >= 0.02
+    assert count == 2
+
+
+def test_stage_consuming(enabled):
+    """Time spent producing the consumed items is not counted towards the stage."""
+
+    def slow():
+        for num in range(3):
+            sleep(0.02)
+            yield num
+
+    with profiling.stage_consuming("index", slow()) as items:
+        assert list(items) == [0, 1, 2]
+    seconds, count = enabled["index"]
+    assert seconds < 0.02
+    assert count == 3
+
+
+def test_timed(enabled):
+    """Each call of a timed function counts as a pass through its stage."""
+    extract = profiling.timed("extract", len)
+    assert extract("abc") == 3
+    assert extract("de") == 2
+    assert enabled["extract"][1] == 2
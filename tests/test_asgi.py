@@ -0,0 +1,71 @@
+"""Test the asynchronous Plateypus backend."""
+
+from asyncio import run
+from datetime import date
+
+from pytest import fixture
+from shortuuid import uuid
+
+from plateypus import asgi, helpers, models
+
+
+@fixture
+def vehicle():
+    """Yield a Vehicle document that has already been saved and is searchable."""
+    _vehicle = models.Vehicle(
+        country=uuid(),
+        plate=uuid(),
+        first_reg=date(2010, 8, 16),
+        vin=uuid(),
+        maker=uuid(),
+        model=uuid(),
+    )
+    with helpers.elastic() as es_client:
+        _vehicle.save(using=es_client, refresh=True)
+        yield _vehicle
+        _vehicle.delete(using=es_client)
+
+
+def request(method, path, **kwargs):
+    """Serve a single request with the ASGI app, and return the response and its JSON."""
+
+    async def serve():
+        async with asgi.PLATEYPUS.test_app() as app:
+            resp = await getattr(app.test_client(), method)(path, **kwargs)
+            return resp, await resp.get_json()
+
+    return run(serve())
+
+
+def test_search(vehicle):
+    """Search should find the vehicle by any of its fields."""
+    for fields in (
+        dict(country=vehicle.country, maker=vehicle.maker),
+        dict(plate=vehicle.plate),
+        dict(vin=f"{vehicle.vin[:6]}*"),
+    ):
+        resp, hits = request("post", "/search", json=dict(fields=fields))
+        assert resp.status_code == 200
+        assert vehicle.meta.id in [hit["_id"] for hit in hits]
+
+
+def test_search_bad_request():
+    """Submitting a malformed search request should result in HTTP error code 400."""
+    resp, _ = request("post", "/search", json=dict(foo="bar", baz=42))
+    assert resp.status_code == 400
+
+
+def test_vehicle_found(vehicle):
+    """Vehicle details are returned when requesting an existing id."""
+    resp, _vehicle = request("get", f"/vehicle/{vehicle.meta.id}")
+    assert resp.status_code == 200
+    assert _vehicle["country"] == vehicle.country
+    assert _vehicle["first_reg"] == "2010-08-16"
+    _, hits = request("post", "/search", json=dict(fields=dict(plate=vehicle.plate)))
+    assert [hit["_source"] for hit in hits] == [_vehicle]
+
+
+def test_vehicle_not_found():
+    """A non-existent vehicle id should result in HTTP error code 404."""
+    resp, _ = request("get", f"/vehicle/{uuid()}")
+    assert resp.status_code == 404
@@ -1,5 +1,10 @@
 """Test the Plateypus backend."""
 
+from datetime import date
+from json import loads
+
+from elasticsearch.exceptions import RequestError
+from flask_caching import Cache
 from pytest import fixture
 from shortuuid import uuid
 
@@ -28,7 +33,7 @@ def vehicle(scope="module"):
         country=country, plate=plate, vin=vin, maker=maker, model=model
     )
     with helpers.elastic() as es_client:
-        _vehicle.save(using=es_client)
+        _vehicle.save(using=es_client, refresh=True)
         yield _vehicle
         _vehicle.delete(using=es_client)
 
@@ -49,6 +54,31 @@ def test_testing():
     assert testing and isinstance(testing, bool)
 
 
+def test_cache_stats(client):
+    """The ``cache'' endpoint should return hit and miss counts."""
+    resp = client.get("/cache")
+    assert okay(resp)
+    assert set(resp.get_json()) == {"hits", "misses"}
+
+
+def test_cached(monkeypatch):
+    """Cached values are only computed on a miss, and hits and misses are counted."""
+    monkeypatch.setattr(
+        backend,
+        "CACHE",
+        Cache(backend.PLATEYPUS, config=dict(CACHE_TYPE="SimpleCache")),
+    )
+    before = dict(backend.CACHE_STATS)
+    computed = []
+    key = uuid()
+    for _ in range(3):
+        value = backend.cached(key, lambda: computed.append(1) or "value")
+        assert value == "value"
+    assert len(computed) == 1
+    assert backend.CACHE_STATS["hits"] - before["hits"] == 2
+    assert backend.CACHE_STATS["misses"] - before["misses"] == 1
+
+
 def test_echo(client):
     """The ``echo'' endpoint should return whatever is sent to it."""
     payload = dict(foo="bar", baz=42)
@@ -60,6 +90,22 @@ def test_echo(client):
     assert result == expected
 
 
+def test_facets(client, vehicle):
+    """Facets should count the vehicles of a country per maker."""
+    resp = client.get(f"/facets?country={vehicle.country}&size=5")
+    assert okay(resp)
+    counts = resp.get_json()
+    assert set(counts) == {"total", "first_reg", *models.FACETS}
+    assert counts["total"] == 1
+    assert counts["maker"] == [dict(key=vehicle.maker.lower(), count=1)]
+
+
+def test_facets_bad_request(client):
+    """Asking for too many values per facet should result in HTTP error code 400."""
+    resp = client.get("/facets?size=100000")
+    assert resp.status_code == 400
+
+
 def test_favicon(client):
     """A favicon should be available at the default URL."""
     resp = client.get("/favicon.ico")
@@ -67,6 +113,14 @@ def test_favicon(client):
     assert resp.mimetype == "image/vnd.microsoft.icon"
 
 
+def test_generations_null_cache(mocker):
+    """With the null cache, nothing is cached, so no generations are looked up."""
+    search = mocker.patch.object(backend.Metadata, "search")
+    assert not backend.CACHING
+    assert backend.generations() == {}
+    search.assert_not_called()
+
+
 def test_search(client, vehicle):
     """Search should return something."""
     payload = dict(fields=dict(country=vehicle.country, maker=vehicle.maker))
@@ -86,6 +140,44 @@ def test_search(client, vehicle):
     assert okay(resp)
 
 
+def test_search_page(client, vehicle):
+    """Search should return pages of hits without raw XML, and a cursor when full."""
+    payload = dict(fields=dict(country=vehicle.country), size=1)
+    resp = client.post("/search", json=payload)
+    assert okay(resp)
+    hits = resp.get_json()
+    assert len(hits) <= 1
+    assert all("raw_xml" not in hit["_source"] for hit in hits)
+    if hits:
+        assert "X-Search-After" in resp.headers
+        payload["search_after"] = loads(resp.headers["X-Search-After"])
+        assert okay(client.post("/search", json=payload))
+
+
+def test_search_batch(client, vehicle):
+    """Batch search should return one result per search, in order."""
+    payload = dict(
+        fields=[
+            dict(country=vehicle.country, maker=vehicle.maker),
+            dict(foo="bar"),
+            dict(vin=vehicle.vin),
+        ]
+    )
+    resp = client.post("/search/batch", json=payload)
+    assert okay(resp)
+    results = resp.get_json()
+    assert len(results) == 3
+    assert "hits" in results[0]
+    assert "error" in results[1]
+    assert "hits" in results[2]
+
+
+def test_search_batch_bad_request(client):
+    """Submitting anything but a list of fields should result in HTTP error code 400."""
+    resp = client.post("/search/batch", json=dict(fields=dict(plate="AB12345")))
+    assert resp.status_code == 400
+
+
 def test_search_bad_request(client):
     """Submitting a malformed search request should result in HTTP error code 400."""
     payload = dict(foo="bar", baz=42)
@@ -93,6 +185,36 @@ def test_search_bad_request(client):
     assert resp.status_code == 400
 
 
+def test_suggest(client, vehicle):
+    """Suggestions should complete the prefix of a plate of the given country only."""
+    prefix = vehicle.plate[:4]
+    resp = client.get(f"/suggest?country={vehicle.country}&prefix={prefix.lower()}")
+    assert okay(resp)
+    assert helpers.normalise_plate(vehicle.plate) in resp.get_json()
+    resp = client.get(f"/suggest?country={uuid()}&prefix={prefix}&size=1")
+    assert okay(resp)
+    assert resp.get_json() == []
+
+
+def test_suggest_bad_request(client):
+    """A suggestion request without a prefix or a country should result in
+    HTTP error code 400."""
+    resp = client.get("/suggest?country=DK")
+    assert resp.status_code == 400
+    resp = client.get("/suggest?prefix=AB1")
+    assert resp.status_code == 400
+
+
+def test_suggest_rejected(client, mocker):
+    """A suggestion request rejected by Elasticsearch should be answered with
+    its status code, not a server error."""
+    mocker.patch.object(backend.Vehicle, "search").side_effect = RequestError(
+        400, "search_phase_execution_exception", {}
+    )
+    resp = client.get(f"/suggest?country={uuid()}&prefix=AB1")
+    assert resp.status_code == 400
+
+
 def test_version(client):
     """The ``version'' endpoint should return the version defined in the backend."""
     resp = client.get("/")
@@ -116,6 +238,39 @@ def test_vehicle_found(client, vehicle):
     assert resp.json["vin"] == vehicle.vin
     assert resp.json["maker"] == vehicle.maker
     assert resp.json["model"] == vehicle.model
+    assert "raw_xml" not in resp.json
+
+
+def test_vehicle_raw_xml(client):
+    """The raw XML of a vehicle is only returned when asked for."""
+    _vehicle = models.Vehicle(country=uuid(), plate=uuid(), raw_xml="<Statistik/>")
+    with helpers.elastic() as es_client:
+        _vehicle.save(using=es_client, refresh=True)
+        try:
+            resp = client.get(f"/vehicle/{_vehicle.meta.id}")
+            assert okay(resp)
+            assert "raw_xml" not in resp.json
+            resp = client.get(f"/vehicle/{_vehicle.meta.id}?raw_xml=true")
+            assert okay(resp)
+            assert resp.json["raw_xml"] == "<Statistik/>"
+        finally:
+            _vehicle.delete(using=es_client)
+
+
+def test_vehicle_matches_search(client):
+    """Vehicle details are the same as the source of the vehicle's search hit."""
+    _vehicle = models.Vehicle(country=uuid(), plate=uuid(), first_reg=date(2010, 8, 16))
+    with helpers.elastic() as es_client:
+        _vehicle.save(using=es_client, refresh=True)
+        try:
+            resp = client.get(f"/vehicle/{_vehicle.meta.id}")
+            assert okay(resp)
+            assert resp.json["first_reg"] == "2010-08-16"
+            payload = dict(fields=dict(plate=_vehicle.plate))
+            (hit,) = client.post("/search", json=payload).get_json()
+            assert hit["_source"] == resp.json
+        finally:
+            _vehicle.delete(using=es_client)
 
 
 def test_vehicle_not_found(client):
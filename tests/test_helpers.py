@@ -1,5 +1,6 @@
 """Test the helpers module."""
 
+from concurrent.futures import ThreadPoolExecutor
 from json import loads
 from logging import DEBUG, ERROR, WARNING
 from pathlib import Path
@@ -42,6 +43,18 @@ def test_init_logger_with_logfile(monkeypatch):
         assert msg in log.read()
 
 
+def test_facets_validator(monkeypatch):
+    """Check that facets requests take an optional country and a bounded size."""
+    monkeypatch.setenv("FACETS_MAX_SIZE", "20")
+    fval = helpers.facets_validator()
+    assert fval.validate({})
+    assert fval.document == dict(size=10)
+    assert fval.validate(dict(country="DK", size="20"))
+    assert fval.document == dict(country="DK", size=20)
+    assert not fval.validate(dict(size="21"))
+    assert not fval.validate(dict(country=""))
+
+
 def test_get_setting(monkeypatch):
     """Test that env settings can be retrieved, or if not then a default value is returned."""
     random_key = uuid()
@@ -57,18 +70,46 @@ def test_app_settings(monkeypatch):
     cache_type = choice(["null", "simple", "redis"])
     flask_secret_key = token_urlsafe(16)
     testing = bool(randint(0, 1))
+    cache_redis_url = f"redis://{uuid()}:6379/2"
     monkeypatch.setenv("CACHE_DEFAULT_TIMEOUT", str(cache_default_timeout))
+    monkeypatch.setenv("CACHE_REDIS_URL", cache_redis_url)
     monkeypatch.setenv("CACHE_TYPE", cache_type)
     monkeypatch.setenv("FLASK_SECRET_KEY", flask_secret_key)
     monkeypatch.setenv("FLASK_TESTING", str(testing))
 
     cfg = helpers.app_settings()
     assert cfg["CACHE_DEFAULT_TIMEOUT"] == cache_default_timeout
+    assert "CACHE_REDIS_URL" not in cfg
     assert cfg["CACHE_TYPE"] == cache_type
     assert cfg["SECRET_KEY"] == flask_secret_key
     assert cfg["TESTING"] == testing
 
 
+def test_build_query():
+    """Test that keyword searches are term lookups, optionally with a fuzzy match."""
+    fields = dict(maker="Ford", vin="wf0*", model="Fiesta")
+    assert helpers.build_query("vin", fields, fuzziness=None).to_dict() == dict(
+        wildcard=dict(vin="wf0*")
+    )
+    fields["vin"] = "WF0XXX"
+    assert helpers.build_query("vin", fields, fuzziness=None).to_dict() == dict(
+        term=dict(vin="WF0XXX")
+    )
+    should = helpers.build_query("maker", fields).to_dict()["bool"]["should"]
+    assert dict(term=dict(maker="Ford")) in should
+    assert {"maker.text": dict(query="Ford", fuzziness="AUTO")} in [
+        query["match"] for query in should if "match" in query
+    ]
+
+
+def test_cache_key():
+    """Test that cache keys do not depend on the order of fields."""
+    key = helpers.cache_key("foo", dict(plate="AB12345", country="dk"), None)
+    assert key.startswith("foo/")
+    assert key == helpers.cache_key("foo", dict(country="dk", plate="AB12345"), None)
+    assert key != helpers.cache_key("foo", dict(country="dk", plate="AB12345"), "x")
+
+
 def test_elastic_default(monkeypatch):
     """Test creation of Elasticsearch client."""
     elastic_host = uuid().lower()
@@ -82,6 +123,19 @@ def test_elastic_default(monkeypatch):
         )
 
 
+def test_elastic_shared(monkeypatch):
+    """Test that one client is shared until the connection settings change,
+    and that all clients are dropped on shutdown."""
+    monkeypatch.setenv("ELASTIC_HOST", uuid().lower())
+    with helpers.elastic() as client, helpers.elastic() as same_client:
+        assert client is same_client
+    monkeypatch.setenv("ELASTIC_MAXSIZE", "42")
+    with helpers.elastic() as other_client:
+        assert other_client is not client
+    helpers.close_elastic()
+    assert not helpers.CLIENTS
+
+
 def test_elastic_ssl(monkeypatch):
     """Test creation of HTTPS Elasticsearch client."""
     host = uuid().lower()
@@ -96,6 +150,57 @@ def test_elastic_ssl(monkeypatch):
         )
 
 
+def test_build_plate_query():
+    """Test that plate searches are term lookups on the normalised plate."""
+    assert helpers.build_plate_query("AB1*").to_dict() == dict(
+        term={"plate_norm.prefix": "AB1"}
+    )
+    assert helpers.build_plate_query("*345").to_dict() == dict(
+        term={"plate_norm.suffix": "543"}
+    )
+    assert helpers.build_plate_query("*B12*").to_dict() == dict(
+        term={"plate_norm.infix": "B12"}
+    )
+    partial = helpers.build_plate_query("B12").to_dict()
+    assert {"plate_norm.infix": "B12"} in [
+        should["term"] for should in partial["bool"]["should"]
+    ]
+    assert helpers.build_plate_query("*B*").to_dict() == dict(
+        wildcard=dict(plate_norm="*B*")
+    )
+    partial = helpers.build_plate_query("B").to_dict()
+    assert dict(wildcard=dict(plate_norm="*B*")) in partial["bool"]["should"]
+    assert helpers.build_plate_query("A*5").to_dict() == dict(
+        wildcard=dict(plate_norm="A*5")
+    )
+    assert helpers.build_plate_query("A" * 11).to_dict() == dict(
+        wildcard=dict(plate_norm="A" * 11)
+    )
+
+
+def test_normalise_fields():
+    """Test that surrounding whitespace is stripped from search fields."""
+    fields = dict(country=" dk", plate="ab 123-45 ")
+    assert helpers.normalise_fields(fields) == dict(country="dk", plate="AB12345")
+
+
+def test_normalise_plate():
+    """Test that plates are upper-cased, and whitespace and dashes are removed."""
+    assert helpers.normalise_plate(" ab 12\t345-x ") == "AB12345X"
+    assert helpers.normalise_plate("*b1-2*") == "*B12*"
+
+
+def test_search_batch_validator(monkeypatch):
+    """Check that batch search requests must hold a bounded, non-empty list."""
+    monkeypatch.setenv("SEARCH_BATCH_SIZE", "2")
+    bval = helpers.search_batch_validator()
+    assert not bval.validate({})
+    assert not bval.validate(dict(fields=[]))
+    assert not bval.validate(dict(fields=dict(plate="AB12345")))
+    assert not bval.validate(dict(fields=[{}, {}, {}]))
+    assert bval.validate(dict(fields=[dict(plate="AB12345"), dict(foo="bar")]))
+
+
 def test_search_validator_bad_data():
     """Check that malformed search requests are rejected."""
     sval = helpers.search_validator()
@@ -108,6 +213,13 @@ def test_search_validator_bad_data():
     assert not sval.validate(bad)
     bad = loads('{"fields": {"foo": "bar"}}')
     assert not sval.validate(bad)
+    bad = loads('{"fields": {"plate": "AB1"}, "size": 0}')
+    assert not sval.validate(bad)
+    bad = loads('{"fields": {"plate": "AB1"}, "source": ["content_hash"]}')
+    assert not sval.validate(bad)
+    for cursor in ('[{"a": 1}]', "[1.5]", '["abc", 1.5]', '[true, "abc"]'):
+        bad = loads(f'{{"fields": {{"plate": "AB1"}}, "search_after": {cursor}}}')
+        assert not sval.validate(bad)
 
 
 def test_search_validator_good_data():
@@ -115,3 +227,64 @@ def test_search_validator_good_data():
     sval = helpers.search_validator()
     good = '{"fields": {"country": "DK", "plate": "BC69432"}}'
     assert sval.validate(loads(good))
+    assert helpers.search_page(sval.document) == dict(
+        search_after=None, size=10, source=None
+    )
+    good = (
+        '{"fields": {"plate": "BC6*"}, "size": 50, '
+        '"search_after": [1.5, "abc"], "source": ["plate", "raw_xml"]}'
+    )
+    assert sval.validate(loads(good))
+    assert helpers.search_page(sval.document) == dict(
+        search_after=[1.5, "abc"], size=50, source=["plate", "raw_xml"]
+    )
+
+
+def test_search_validator_fast_path():
+    """Check that the fast path normalises like Cerberus, and errors come from Cerberus."""
+    sval = helpers.search_validator()
+    good = dict(fields=dict(plate="AB1*"), source=["plate"])
+    assert sval.fast_validate(good)
+    assert sval.validate(good)
+    assert sval.document == dict(good, size=10)
+    assert not sval.errors
+    bad = dict(fields=dict(plate="AB1*"), size=True)
+    assert not sval.fast_validate(bad)
+    assert sval.fast_validate(dict(good, search_after=[1, "abc"]))
+    assert not sval.fast_validate(dict(good, search_after=[{"a": 1}]))
+    assert not sval.validate(dict(fields=dict(plate="")))
+    assert sval.errors == dict(fields=[dict(plate=["empty values not allowed"])])
+
+
+def test_search_validator_per_thread():
+    """Check that validators are reused within a thread, but not shared between threads."""
+    sval = helpers.search_validator()
+    assert helpers.search_validator() is sval
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(helpers.search_validator).result() is not sval
+
+
+def test_search_validator_settings(monkeypatch):
+    """Check that validators are only reused while their settings are unchanged."""
+    monkeypatch.setenv("SEARCH_MAX_SIZE", "100")
+    sval = helpers.search_validator()
+    monkeypatch.setenv("SEARCH_MAX_SIZE", "20")
+    assert helpers.search_validator() is not sval
+    assert helpers.search_validator().schema["size"]["max"] == 20
+    monkeypatch.setenv("SEARCH_MAX_SIZE", "100")
+    assert helpers.search_validator() is sval
+
+
+def test_suggest_validator(monkeypatch):
+    """Check that suggestion requests need a country, a prefix and a bounded size."""
+    monkeypatch.setenv("SUGGEST_MAX_SIZE", "5")
+    sval = helpers.suggest_validator()
+    assert not sval.validate({})
+    assert not sval.validate(dict(prefix="AB"))
+    assert not sval.validate(dict(prefix="", country="DK"))
+    assert not sval.validate(dict(prefix="AB", country="DK", size="6"))
+    assert not sval.validate(dict(prefix="AB", country="DK", size="many"))
+    assert sval.validate(dict(prefix="AB", country="DK"))
+    assert sval.document["size"] == 5
+    assert sval.validate(dict(prefix="AB", country="DK", size="3"))
+    assert sval.document["size"] == 3